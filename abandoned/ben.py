@@ -29,10 +29,11 @@ def loop_matrix(n):
         list[0,i] = i
     return list
 
-P = patch.singleChannelPatch(channel.khh)
-#voltages = [channel.V0,channel.V1,channel.V2,channel.V1]  # repeat V1; repeated variables affect differentiation via chain rule
+canonical = channel.canonical()  # the khh channel and its parameters
+P = patch.singleChannelPatch(canonical.khh, canonical.VOLTAGE)
+#voltages = [canonical.V0,canonical.V1,canonical.V2,canonical.V1]  # repeat V1; repeated variables affect differentiation via chain rule
 #voltageStepDurations = [0*u.ms,patch.default_tstop,patch.default_tstop,patch.default_tstop]  # default_tstop is a global parameter
-voltages = [channel.V0,channel.V1,channel.V0,channel.V2]
+voltages = [canonical.V0,canonical.V1,canonical.V0,canonical.V2]
 voltageStepDurations = [numpy.inf,patch.default_tstop,numpy.inf,patch.default_tstop]
 S = patch.StepProtocol(P,voltages,voltageStepDurations)
 FS = S.flatten(3)
@@ -1,5 +1,6 @@
 import numpy
 import parameter
+import kernel
 from parameter import u
 
 
@@ -85,19 +86,38 @@ class Channel(object):
             n.weight = 0.
 
     def makeQ(self):
-        # make Q with units
-        s = len(self.QList[0])  # QList should be square
-        Q = numpy.matrix(numpy.zeros([s, s])) / u.millisecond  # QList should be square
-        for row in range(s):
-            for element in range(s):
-                if self.QList[row][element] == 0.:
-                    Q[row, element] = 0 / u.millisecond
-                else:
-                    Q[row, element] = parameter.v(self.QList[row][element])
-        # Add diagonal (not zero)
-        Qdiag = -Q.sum(axis=1)
-        numpy.fill_diagonal(Q, Qdiag)
-        return Q
+        # make Q with units; values are computed without units by the compiled kernel
+        return numpy.matrix(self.getKernel().Q()) / u.millisecond
+
+    def makeQs(self, stimulus, volts, voltageUnit='mV', timeUnit='ms'):
+        # Stacked Q without units (nV x s x s) in 1/timeUnit for an array of volts in voltageUnit
+        return self.getKernel(stimulus, voltageUnit, timeUnit).Qs(volts=volts)
+
+    def jacobianQ(self, stimulus=None, volts=None, voltageUnit='mV', timeUnit='ms'):
+        # Q without units and its derivatives with respect to every parameter of the channel's Space:
+        # dQ[..., i, j, k] = dQ[..., i, j]/d(names[k]), each parameter in its own units
+        K = self.getKernel(stimulus, voltageUnit, timeUnit)
+        Q, dQK = K.jacobian(volts=volts)
+        names = sorted(self.PS.pDict)
+        dQ = numpy.zeros(Q.shape + (len(names),))
+        dQ[..., [names.index(name) for name in K.names]] = dQK
+        return Q, dQ, names
+
+    def getKernel(self, stimulus=None, voltageUnit='mV', timeUnit='ms'):
+        # Compiles the rates once (checking dimensions) and caches the kernel, per stimulus object and units,
+        # until the graph changes or the names, units or expressions it was compiled from do (RateKernel.stale)
+        key = (None if stimulus is None else id(stimulus), voltageUnit, timeUnit)
+        K = self.kernels.get(key)
+        if K is not None and not K.stale():
+            return K
+        with kernel.compileLock:
+            K = self.kernels.get(key)
+            if K is None or K.stale():  # another thread may have compiled it meanwhile
+                preferred = parameter.preferredUnits()
+                preferred.voltage = voltageUnit
+                preferred.time = timeUnit
+                self.kernels[key] = kernel.RateKernel(self, stimulus, preferred)
+        return self.kernels[key]
 
     def makeMean(self):
         return [parameter.v(n.level.mean) for n in self.nodes]  # Records means of nodes (conductances) in list
@@ -150,41 +170,77 @@ class Channel(object):
         self.QList.append(newrow)
 
     def addNode(self, new):
-        self.nodes.append(new)
-        self.PS.append(new.level.PS)
-        self.recordOrder()
-        self.padQList()
-        self.integrity()
+        self.addNodes([new])
 
-    # The next three functions define/modify the edges
+    def addNodes(self, new):
+        # Adds several nodes.  They are checked before the channel is changed, so a failed check leaves it
+        # as it was; integrity() then checks the whole channel, as the constructor does.
+        added = parameter.emptySpace()
+        for n in new:
+            assert (isinstance(n, Node))
+            added.append(n.level.PS)
+        names = [n.name for n in new]
+        assert (len(set(names)) == len(names) and not any(name in self.nodeOrder for name in names))  # distinct
+        assert (len(set(self.nodes + list(new))) == len(self.nodes) + len(new))  # make sure nodes are distinct
+        self.PS.check(added)
+        for n in new:
+            self.nodeOrder[n.name] = len(self.nodes)
+            self.nodes.append(n)
+            self.padQList()
+        self.integrity()  # rebuilds the parameter space and drops compiled kernels
+
+    # The next five functions define/modify the edges
     def disconnect(self):
         #disconnect() defines a disconnected graph; no transitions
         self.QList = numpy.matrix(numpy.zeros(shape=(len(self.nodes), len(self.nodes)))).tolist()
+        self.transitions = {}  # edge list: {(row, column): rate}, nonzero entries of QList
         self.integrity()  # calls makeQ() and reparameterize()
 
     def biEdge(self, node1, node2, q12, q21):
         #addBiEdge() modifies parameters of a transition in both directions
-        first = self.nodeOrder[node1]
-        second = self.nodeOrder[node2]
-        self.QList[first][second] = q12  # first row, second column, order reverse in list
-        self.QList[second][first] = q21  # second row, first column
-        self.integrity()  # calls makeQ() and reparameterize()
+        self.biEdges([(node1, node2, q12, q21)])
 
     def edge(self, node1, node2, q12):
         #addEdge() modifies parameters of a transition in one direction
-        first = self.nodeOrder[node1]
-        second = self.nodeOrder[node2]
-        self.QList[first][second] = q12
-        self.integrity()  # calls makeQ() and reparameterize()
+        self.edges([(node1, node2, q12)])
+
+    def biEdges(self, edges):
+        # edges is a list of (node1, node2, q12, q21)
+        self.edges([e for node1, node2, q12, q21 in edges
+                    for e in ((node1, node2, q12), (node2, node1, q21))])
+
+    def edges(self, edges):
+        # edges is a list of (node1, node2, q12).  The parameter space of the new transitions is built
+        # (and checked) before the channel is changed; integrity() then checks the whole channel.
+        resolved = []
+        for node1, node2, q12 in edges:
+            first = self.nodeOrder[node1]
+            second = self.nodeOrder[node2]
+            assert (first != second)
+            resolved.append((first, second, q12))
+        transitions = dict(self.transitions)
+        for first, second, q12 in resolved:
+            if q12 == 0.:
+                transitions.pop((first, second), None)
+            else:
+                transitions[(first, second)] = q12
+        self.space(transitions)  # asserts that the rates' parameters agree with the channel's
+        for first, second, q12 in resolved:
+            self.QList[first][second] = q12  # first row, second column
+        self.transitions = transitions
+        self.integrity()  # rebuilds the parameter space and drops compiled kernels
+
+    def space(self, transitions):  # the parameter space of the nodes and the given transitions
+        PS = parameter.emptySpace()
+        for n in self.nodes:
+            PS.append(n.level.PS)
+        for element in transitions.itervalues():
+            PS.append(parameter.getSpace(element))
+        return PS
 
     def reparameterize(self):
         # defines parameter space;  called by integrity()
-        self.PS = parameter.emptySpace()  # clear the parameter space
-        for n in self.nodes:
-            self.PS.append(n.level.PS)  # now recreate the parameter space from just nodes
-        for rownum in range(len(self.QList)):
-            for element in self.QList[rownum]:
-                self.PS.append(parameter.getSpace(element))
+        self.PS = self.space(self.transitions)
 
     def makeLevelMap(self):
         nonUniqueLevels = []
@@ -206,74 +262,96 @@ class Channel(object):
             assert (isinstance(n, Node))
         assert (len(self.nodes) == len(self.getNodeNames()))  # makes sure node names are distinct
         assert (len(self.nodes) == len(set(self.nodes)))  # make sure nodes are distinct
+        assert (all(self.nodeOrder[n.name] == i for i, n in enumerate(self.nodes)))  # index agrees with nodes
         #Edges
+        assert (len(self.QList) == len(self.nodes) and all(len(row) == len(self.nodes) for row in self.QList))
         for n in range(len(self.nodes)):
             assert (self.QList[n][n] == 0)
+        for (row, column), q in self.transitions.iteritems():
+            assert (0 <= row < len(self.nodes) and 0 <= column < len(self.nodes))  # no dangling edges
+            assert (self.QList[row][column] is q)  # edge list agrees with QList
         #Q0 = self.Q.copy()  # Q0 is for checking that off diagonal is positive
         #numpy.fill_diagonal(Q0,0.)  # diagonal is negative so set to zero
         #assert(numpy.amin(Q0)==0)  # now minimum element should be zero (on diagonal)
         #assert(self.Q.shape == (len(self.nodes),len(self.nodes)))
         self.reparameterize()
+        self.kernels = {}  # compiled rates are stale once nodes or edges change
+
+
+# The canonical channel (khh) is built on first use by canonical(), not when the module is imported
+class Canonical(object):
+    def __init__(self):
+        # This code sets up a canonical channel
+        # EK,ENa,EL are Hodgkin Huxley values take from http://icwww.epfl.ch/~gerstner/SPNM/node14.html
+        self.EK = parameter.Parameter("EK", -12-65, "mV", log=False)
+        self.ENa = parameter.Parameter("ENa", 115-65, "mV", log=False)
+        self.EL = parameter.Parameter("EL", 10.6-65, "mV", log=False)
+        # gNa,gK, gL are Hodgkin Huxley values take from http://icwww.epfl.ch/~gerstner/SPNM/node14.html
+        self.gNa = parameter.Parameter("gNa", 120, "mS/cm^2", log=True)
+        self.gK = parameter.Parameter("gK", 36, "mS/cm^2", log=True)
+        self.gL = parameter.Parameter("gL", 0.3, "mS/cm^2", log=True)
+        # I = gV
+        # gmax_khh is from www.neuron.yale.edu, but is a density parameter inappropriate for a single channel; use g_open instead
+        self.gmax_khh = parameter.Parameter("gmax_khh", 0.02979, "microsiemens", log=True)
+        # "The single-channel conductance of typical ion channels ranges from 0.1 to 100 pS (picosiemens)."  Bertil Hille (2008), Scholarpedia, 3(10):6051.
+        # For now, g_open is used only for plotting
+        self.g_open = parameter.Parameter("g_open", 1., "picosiemens", log=True)
+        # gNa_open, gK_open from  Adam Strassber and Louis DeFelice "Limitations of the Hodgkin-Huxley Formalism: Effects of
+        # single channel kinetics on Transmembrane Voltage Dynamics, Neural Computation 5, 843-855 (1993) PAGE 845
+        self.gK_open = parameter.Parameter("gK_open", 20., "picosiemens", log=True)
+        self.gNa_open = parameter.Parameter("gNa_open", 20., "picosiemens", log=True)
+        # The following two parameters were made up (but they are not used at the moment):
+        self.gstd_open = parameter.Parameter("gstd_open", 0.1, "picosiemens", log=True)
+        self.gstd_closed = parameter.Parameter("gstd_closed", 0.01, "picosiemens", log=True)
+
+        # The rest of these parameters come from www.neuron.yale.edu (khh channel) channel builder tutorial
+        self.ta1 = parameter.Parameter("ta1", 4.4, "ms", log=True)
+        self.tk1 = parameter.Parameter("tk1", -0.025, "1/mV", log=False)
+        self.d1 = parameter.Parameter("d1", 21., "mV", log=False)
+        self.k1 = parameter.Parameter("k1", 0.2, "1/mV", log=False)
+
+        self.ta2 = parameter.Parameter("ta2", 2.6, "ms", log=True)
+        self.tk2 = parameter.Parameter("tk2", -0.007, "1/mV", log=False)
+        self.d2 = parameter.Parameter("d2", 43, "mV", log=False)
+        self.k2 = parameter.Parameter("k2", 0.036, "1/mV", log=False)
+
+        self.V0 = parameter.Parameter("V0", -65., "mV", log=False)
+        self.V1 = parameter.Parameter("V1", 20., "mV", log=False)
+        self.V2 = parameter.Parameter("V2", -80., "mV", log=False)
+        # The parameter VOLTAGE is set by voltage-clamp in patch.py
+        self.VOLTAGE = parameter.Parameter("VOLTAGE", -65., "mV", log=False)
+        self.OFFSET = parameter.Parameter("OFFSET", 65., "mV", log=False)
+        self.VOLTAGE.remap(self.V0)
+
+        self.vr = parameter.Expression("vr", "VOLTAGE + OFFSET", [self.VOLTAGE, self.OFFSET])
+        self.tau1 = parameter.Expression("tau1", "ta1*exp(tk1*vr)", [self.ta1, self.tk1, self.vr])
+        self.K1 = parameter.Expression("K1", "exp((k2*(d2-vr))-(k1*(d1-vr)))", [self.k1, self.k2, self.d1, self.d2, self.vr])
+        self.tau2 = parameter.Expression("tau2", "ta2*exp(tk2*vr)", [self.ta2, self.tk2, self.vr])
+        self.K2 = parameter.Expression("K2", "exp(-(k2*(d2-vr)))", [self.k2, self.d2, self.vr])
+
+        self.a1 = parameter.Expression("a1", "K1/(tau1*(K1+1))", [self.K1, self.tau1])
+        self.b1 = parameter.Expression("b1", "1/(tau1*(K1+1))", [self.K1, self.tau1])
+        self.a2 = parameter.Expression("a2", "K2/(tau2*(K2+1))", [self.K2, self.tau2])
+        self.b2 = parameter.Expression("b2", "1/(tau2*(K2+1))", [self.K2, self.tau2])
+
+        self.Open = Level("Open", mean=self.g_open, std=self.gstd_open)
+        self.Closed = Level("Closed", mean=0. * u.picosiemens, std=self.gstd_closed)
+        self.C1 = Node("C1", self.Closed)
+        self.C2 = Node("C2", self.Closed)
+        self.O = Node("O", self.Open)
+        self.khh = Channel([self.C1, self.C2, self.O])
+        self.khh.biEdge("C1", "C2", self.a1, self.b1)
+        self.khh.edge("C2", "O", self.a2)
+        self.khh.edge("O", "C2", self.b2)
+
+
+canonicalModels = None
+
+
+def canonical():
+    # e.g. channel.canonical().khh and channel.canonical().VOLTAGE
+    global canonicalModels
+    if canonicalModels is None:
+        canonicalModels = Canonical()
+    return canonicalModels
 
-# This code sets up a canonical channel
-# EK,ENa,EL are Hodgkin Huxley values take from http://icwww.epfl.ch/~gerstner/SPNM/node14.html
-EK = parameter.Parameter("EK", -12-65, "mV", log=False)
-ENa = parameter.Parameter("ENa", 115-65, "mV", log=False)
-EL = parameter.Parameter("EL", 10.6-65, "mV", log=False)
-# gNa,gK, gL are Hodgkin Huxley values take from http://icwww.epfl.ch/~gerstner/SPNM/node14.html
-gNa = parameter.Parameter("gNa", 120, "mS/cm^2", log=True)
-gK = parameter.Parameter("gK", 36, "mS/cm^2", log=True)
-gL = parameter.Parameter("gL", 0.3, "mS/cm^2", log=True)
-# I = gV
-# gmax_khh is from www.neuron.yale.edu, but is a density parameter inappropriate for a single channel; use g_open instead
-gmax_khh = parameter.Parameter("gmax_khh", 0.02979, "microsiemens", log=True)
-# "The single-channel conductance of typical ion channels ranges from 0.1 to 100 pS (picosiemens)."  Bertil Hille (2008), Scholarpedia, 3(10):6051.
-# For now, g_open is used only for plotting
-g_open = parameter.Parameter("g_open", 1., "picosiemens", log=True)
-# gNa_open, gK_open from  Adam Strassber and Louis DeFelice "Limitations of the Hodgkin-Huxley Formalism: Effects of
-# single channel kinetics on Transmembrane Voltage Dynamics, Neural Computation 5, 843-855 (1993) PAGE 845
-gK_open = parameter.Parameter("gK_open", 20., "picosiemens", log=True)
-gNa_open = parameter.Parameter("gNa_open", 20., "picosiemens", log=True)
-# The following two parameters were made up (but they are not used at the moment):
-gstd_open = parameter.Parameter("gstd_open", 0.1, "picosiemens", log=True)
-gstd_closed = parameter.Parameter("gstd_closed", 0.01, "picosiemens", log=True)
-
-# The rest of these parameters come from www.neuron.yale.edu (khh channel) channel builder tutorial
-ta1 = parameter.Parameter("ta1", 4.4, "ms", log=True)
-tk1 = parameter.Parameter("tk1", -0.025, "1/mV", log=False)
-d1 = parameter.Parameter("d1", 21., "mV", log=False)
-k1 = parameter.Parameter("k1", 0.2, "1/mV", log=False)
-
-ta2 = parameter.Parameter("ta2", 2.6, "ms", log=True)
-tk2 = parameter.Parameter("tk2", -0.007, "1/mV", log=False)
-d2 = parameter.Parameter("d2", 43, "mV", log=False)
-k2 = parameter.Parameter("k2", 0.036, "1/mV", log=False)
-
-V0 = parameter.Parameter("V0", -65., "mV", log=False)
-V1 = parameter.Parameter("V1", 20., "mV", log=False)
-V2 = parameter.Parameter("V2", -80., "mV", log=False)
-# The parameter VOLTAGE is set by voltage-clamp in patch.py
-VOLTAGE = parameter.Parameter("VOLTAGE", -65., "mV", log=False)
-OFFSET = parameter.Parameter("OFFSET", 65., "mV", log=False)
-VOLTAGE.remap(V0)
-
-vr = parameter.Expression("vr", "VOLTAGE + OFFSET", [VOLTAGE, OFFSET])
-tau1 = parameter.Expression("tau1", "ta1*exp(tk1*vr)", [ta1, tk1, vr])
-K1 = parameter.Expression("K1", "exp((k2*(d2-vr))-(k1*(d1-vr)))", [k1, k2, d1, d2, vr])
-tau2 = parameter.Expression("tau2", "ta2*exp(tk2*vr)", [ta2, tk2, vr])
-K2 = parameter.Expression("K2", "exp(-(k2*(d2-vr)))", [k2, d2, vr])
-
-a1 = parameter.Expression("a1", "K1/(tau1*(K1+1))", [K1, tau1])
-b1 = parameter.Expression("b1", "1/(tau1*(K1+1))", [K1, tau1])
-a2 = parameter.Expression("a2", "K2/(tau2*(K2+1))", [K2, tau2])
-b2 = parameter.Expression("b2", "1/(tau2*(K2+1))", [K2, tau2])
-
-Open = Level("Open", mean=g_open, std=gstd_open)
-Closed = Level("Closed", mean=0. * u.picosiemens, std=gstd_closed)
-C1 = Node("C1", Closed)
-C2 = Node("C2", Closed)
-O = Node("O", Open)
-khh = Channel([C1, C2, O])
-khh.biEdge("C1", "C2", a1, b1)
-khh.edge("C2", "O", a2)
-khh.edge("O", "C2", b2)
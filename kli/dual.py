@@ -0,0 +1,122 @@
+import numpy
+
+
+# A Dual carries a value x and its derivatives dx with respect to n parameters (forward-mode
+# automatic differentiation).  x may be a scalar or an array (e.g. over voltages); dx has one
+# more trailing axis, of length n, than x.  Unlike ad.adnumber the derivatives of a whole array
+# are held in one numpy array, so evaluating an expression costs a few numpy operations.
+class Dual(object):
+    __array_priority__ = 100  # numpy arrays defer to Dual in mixed arithmetic
+
+    def __init__(self, x, dx):
+        self.x = x
+        self.dx = dx
+
+    def __repr__(self):
+        return 'Dual(%s, %s)' % (repr(self.x), repr(self.dx))
+
+    def __neg__(self):
+        return Dual(-self.x, -self.dx)
+
+    def __pos__(self):
+        return self
+
+    def __add__(self, y):
+        if isinstance(y, Dual):
+            return Dual(self.x + y.x, self.dx + y.dx)
+        return Dual(self.x + y, self.dx + 0. * trailing(y))
+
+    def __sub__(self, y):
+        if isinstance(y, Dual):
+            return Dual(self.x - y.x, self.dx - y.dx)
+        return Dual(self.x - y, self.dx + 0. * trailing(y))
+
+    def __mul__(self, y):
+        if isinstance(y, Dual):
+            return Dual(self.x * y.x, self.dx * trailing(y.x) + trailing(self.x) * y.dx)
+        return Dual(self.x * y, self.dx * trailing(y))
+
+    def __div__(self, y):
+        if isinstance(y, Dual):
+            return Dual(self.x / y.x, (self.dx * trailing(y.x) - trailing(self.x) * y.dx) / trailing(y.x * y.x))
+        return Dual(self.x / y, self.dx / trailing(y))
+
+    def __pow__(self, y):
+        if isinstance(y, Dual):
+            z = self.x ** y.x
+            return Dual(z, trailing(z) * (y.dx * trailing(numpy.log(self.x)) + trailing(y.x / self.x) * self.dx))
+        return Dual(self.x ** y, trailing(y * self.x ** (y - 1)) * self.dx)
+
+    def __radd__(self, y):
+        return self + y
+
+    def __rsub__(self, y):
+        return Dual(y - self.x, -self.dx + 0. * trailing(y))
+
+    def __rmul__(self, y):
+        return self * y
+
+    def __rdiv__(self, y):
+        return Dual(y / self.x, -trailing(y / (self.x * self.x)) * self.dx)
+
+    def __rpow__(self, y):
+        z = y ** self.x
+        return Dual(z, trailing(z * numpy.log(y)) * self.dx)
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+
+def trailing(x):  # adds the parameter axis so that x broadcasts against dx
+    return numpy.asarray(x)[..., numpy.newaxis]
+
+
+def exp(x):
+    if isinstance(x, Dual):
+        z = numpy.exp(x.x)
+        return Dual(z, trailing(z) * x.dx)
+    return numpy.exp(x)
+
+
+def log(x):
+    if isinstance(x, Dual):
+        return Dual(numpy.log(x.x), x.dx / trailing(x.x))
+    return numpy.log(x)
+
+
+def log10(x):
+    if isinstance(x, Dual):
+        return Dual(numpy.log10(x.x), x.dx / trailing(x.x * numpy.log(10.)))
+    return numpy.log10(x)
+
+
+def sin(x):
+    if isinstance(x, Dual):
+        return Dual(numpy.sin(x.x), trailing(numpy.cos(x.x)) * x.dx)
+    return numpy.sin(x)
+
+
+def cos(x):
+    if isinstance(x, Dual):
+        return Dual(numpy.cos(x.x), -trailing(numpy.sin(x.x)) * x.dx)
+    return numpy.cos(x)
+
+
+def tan(x):
+    if isinstance(x, Dual):
+        c = numpy.cos(x.x)
+        return Dual(numpy.tan(x.x), x.dx / trailing(c * c))
+    return numpy.tan(x)
+
+
+def seed(values, factors=None):
+    # independent variables: one Dual per value, the derivative of the ith with respect to itself is factors[i]
+    n = len(values)
+    if factors is None:
+        factors = numpy.ones(n)
+    duals = []
+    for i in range(n):
+        dx = numpy.zeros(n)
+        dx[i] = factors[i]
+        duals.append(Dual(values[i], dx))
+    return duals
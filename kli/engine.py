@@ -4,7 +4,6 @@ import random
 import time
 import copy
 import parameter
-import pandas
 import toy
 from parameter import u
 
@@ -23,10 +22,11 @@ class FlatStepProtocol(toy.FlatToy):
         self.allInitializations = self.setUpInitializations(self.thePatch.ch.timeZeroDistribution(),
                 self.thePatch.equilibrium)  # equilibrium is a function
         self.processNodes(self.thePatch.ch.nodes)
-        self.A = tuple([self.thePatch.makeA(v, self.dt,
+        self.A = tuple(self.thePatch.makeAs(self.voltages, self.dt,
                                             self.preferredVoltage,
-                                            self.preferredTime) for v in self.voltages])
+                                            self.preferredTime))
         self.makeB()  # NO-NOISE only
+        self.parameterVersion = self.thePatch.ch.PS.version()  # of the values A was made from
         self.hasVoltTraj = False  # hasVoltTraj used in self.voltageTrajectory() for dataFrame
         assert not self.hasNoise  # Will add noise later
 
@@ -57,12 +57,22 @@ class FlatStepProtocol(toy.FlatToy):
         if nodesChanged:
             self.processNodes(parent.thePatch.ch.nodes)
         if QChanged:
-            self.A = tuple([parent.thePatch.makeA(v, self.dt,
+            self.A = tuple(parent.thePatch.makeAs(self.voltages, self.dt,
                                             self.preferredVoltage,
-                                            self.preferredTime) for v in self.voltages])
+                                            self.preferredTime))
             self.makeB()  # NO-NOISE only.
+            self.parameterVersion = self.thePatch.ch.PS.version()
         self._restart()
 
+    def refresh(self):
+        # Once the channel's parameters are assigned (e.g. by Space.assignVector), A and the initializations
+        # are remade; data and likelihoods belong to the old values, so they start afresh (as in _restart)
+        if self.thePatch.ch.PS.version() != self.parameterVersion:
+            self.unpackExperiment()
+            self.simRNG.reset()
+            self.startData()
+            self.startLikes()
+
     def setUpInitializations(self, timeZeroInitialization, equilibrium):
         # Initializations occur when the voltage clamp is held for a long time without collecting
         # data. The initializations, except possibly the first one at time zero are determined
@@ -204,12 +214,14 @@ class FlatStepProtocol(toy.FlatToy):
                 DFDataT.append(self.simDataTM[i])  # TM means Time Magnitude (no units)
                 DFDataV.append(self.simDataVM[i])  # VM means Voltage Magnitude (no units)
             counter += 1
+        import pandas  # imported on first use; pandas is slow to import
         TLabel = 'T_' + self.preferredTime
         VLabel = 'V_' + self.preferredVoltage
         dataDict = {TLabel: DFDataT, 'Node': DFNodes, VLabel: DFDataV}
         return (pandas.DataFrame(dataDict, columns=[TLabel, 'Node', VLabel]))
 
     def likeDataFrame(self,rep=0, downsample=0):
+        import pandas  # imported on first use; pandas is slow to import
         PC0 = []
         PC1 = []
         POpen = []
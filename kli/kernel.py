@@ -0,0 +1,275 @@
+import numpy
+import scipy.linalg
+import threading
+import parameter
+import dual
+from parameter import u
+
+# Pint base unit for every base dimension; used to complete a system of units
+# when the preferred units do not span all the dimensions a model uses
+baseUnits = (('[time]', 'second'), ('[length]', 'meter'), ('[mass]', 'kilogram'),
+             ('[current]', 'ampere'), ('[temperature]', 'kelvin'),
+             ('[substance]', 'mole'), ('[luminosity]', 'candela'))
+
+
+compileLock = threading.Lock()  # compiling evaluates Expressions, which record their last values
+
+
+def defaultPreferred():
+    preferred = parameter.preferredUnits()
+    preferred.time = 'ms'
+    preferred.voltage = 'mV'
+    return preferred
+
+
+class UnitSystem(object):
+    # A coherent system of units built from preferred units (time, voltage, conductance, ...)
+    # completed with pint base units.  In a coherent system products and quotients of magnitudes
+    # are magnitudes of products and quotients, so expressions can be evaluated on bare floats.
+    def __init__(self, preferred):
+        self.dims = [d for d, b in baseUnits]
+        candidates = [getattr(preferred, name, None) for name in ('time', 'voltage', 'conductance', 'current')]
+        candidates = [c for c in candidates if c is not None] + [b for d, b in baseUnits]
+        self.basis = []
+        columns = []
+        for c in candidates:
+            column = self.dimensionVector(u.Quantity(1., c))
+            trial = numpy.array(columns + [column]).T
+            if numpy.linalg.matrix_rank(trial) > len(columns):  # skip units that are products of the basis
+                self.basis.append(c)
+                columns.append(column)
+        self.M = numpy.array(columns).T
+        self.factors = {}
+
+    def dimensionVector(self, quantity):
+        dimensionality = quantity.dimensionality
+        for d in dimensionality:
+            assert d in self.dims  # base dimension unknown to the system
+        return [float(dimensionality[d]) if d in dimensionality else 0. for d in self.dims]
+
+    def coherentUnits(self, quantity):
+        # units of the system having the same dimensionality as quantity
+        d = numpy.array(self.dimensionVector(quantity))
+        exponents = numpy.round(numpy.linalg.lstsq(self.M, d, rcond=-1)[0])
+        assert numpy.array_equal(self.M.dot(exponents), d)  # fractional powers are not supported
+        coherent = u.Quantity(1., 'dimensionless')
+        for b, e in zip(self.basis, exponents):
+            if e != 0:
+                coherent = coherent * u.Quantity(1., b) ** int(e)
+        return coherent.units
+
+    def factor(self, units):
+        # multiplies a magnitude in units to give the magnitude in the coherent system
+        key = str(units)
+        try:
+            return self.factors[key]
+        except KeyError:
+            pass
+        q = u.Quantity(1., units)
+        f = float(q.to(self.coherentUnits(q)).magnitude)  # raises pint.DimensionalityError if inconsistent
+        self.factors[key] = f
+        return f
+
+
+class UnitFactors(object):
+    # Replaces the unit registry u inside compiled expressions: u.mV is the magnitude of 1 mV
+    def __init__(self, system):
+        self.system = system
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        f = self.system.factor(name)
+        setattr(self, name, f)  # later lookups bypass __getattr__
+        return f
+
+
+# A RateKernel is the unit-free compiled form of the rates of a Channel
+class RateKernel(object):
+    def __init__(self, ch, stimulus=None, preferred=None):
+        if preferred is None:
+            preferred = defaultPreferred()
+        self.preferred = preferred
+        self.system = UnitSystem(preferred)
+        self.rateUnits = '1/' + preferred.time
+        self.s = len(ch.nodes)
+        self.compileEntries(ch)
+        self.compileParameters(stimulus)
+        self.compileExpressions()
+        self.source = stimulus  # kept, as the kernel cache is keyed by its id
+        self.PS = parameter.Space(self.parameters + self.rates.values())  # what was compiled
+        self.structure = self.PS.structure()
+        # magnitudes of the remapped parameters, evaluated once here (under compileLock) so that vector()
+        # can complete a dict without evaluating Expressions
+        self.mapped = dict((i, m) for i, m in enumerate(self.values()) if self.parameters[i].remapped)
+        self.methods = {"exp": numpy.exp, "log": numpy.log, "sin": numpy.sin, "cos": numpy.cos,
+                        "tan": numpy.tan, "log10": numpy.log10, "pi": numpy.pi, "e": numpy.e,
+                        "u": UnitFactors(self.system), "v": parameter.v}
+        # scale from the coherent rate unit to the preferred rate unit (1.0 unless time is not in the basis)
+        self.rateScale = float(u.Quantity(1., self.system.coherentUnits(u.Quantity(1., self.rateUnits)))
+                               .to(self.rateUnits).magnitude)
+
+    def compileEntries(self, ch):
+        # Checks dimensions of every transition rate once, at compile time
+        self.entries = []  # (row, col, name), name of a parameter or expression
+        self.constants = []  # (row, col, value), value in preferred rate units
+        self.rates = {}
+        for row in range(self.s):
+            for col in range(self.s):
+                q = ch.QList[row][col]
+                if q == 0.:
+                    continue
+                value = parameter.v(q)
+                if isinstance(q, (parameter.Parameter, parameter.Expression)):
+                    value.to(self.rateUnits)  # raises pint.DimensionalityError
+                    self.entries.append((row, col, q.name))
+                    self.rates[q.name] = q
+                else:
+                    self.constants.append((row, col, parameter.mu(value, self.rateUnits)))
+
+    def compileParameters(self, stimulus):
+        params = {}
+        for q in self.rates.itervalues():
+            params.update(q.getParameters())
+        self.names = sorted(params)
+        self.parameters = [params[name] for name in self.names]
+        self.units = [str(P.value.units) for P in self.parameters]
+        self.factors = numpy.array([self.system.factor(P.value.units) for P in self.parameters])
+        self.stimulus = None
+        if stimulus is not None and params.get(stimulus.name) is stimulus:
+            self.stimulus = stimulus.name
+            self.stimulusFactor = self.system.factor(self.preferred.voltage)
+
+    def compileExpressions(self):
+        # topological order: nested expressions before the expressions that use them
+        self.expressions = []
+        visited = set()
+
+        def visit(E):
+            if E.name in visited:
+                return
+            visited.add(E.name)
+            for nested in E.PS.eDict.itervalues():
+                visit(nested)
+            assert E.name not in self.names  # expression and parameter must have different names
+            self.expressions.append((E.name, compile(E.expr, E.name, 'eval')))
+
+        for q in self.rates.itervalues():
+            if isinstance(q, parameter.Expression):
+                visit(q)
+
+    def stale(self):  # a name, units or expression compiled into the kernel has changed since
+        return self.PS.structure() != self.structure
+
+    def values(self):
+        # magnitudes of the current parameter values, each in the parameter's own units
+        p = numpy.empty(len(self.parameters))
+        for i, P in enumerate(self.parameters):
+            if P.remapped:
+                value = parameter.v(P)
+                p[i] = value.to(self.units[i]).magnitude if hasattr(value, 'to') else value
+            else:
+                p[i] = P.Value()
+        return p
+
+    def vector(self, values):
+        # parameter vector from a {name: magnitude in the parameter's own units} dict or a sequence
+        # ordered as self.names; names missing from a dict take their current values, except remapped
+        # parameters, which take the values they had at compile time.  Nothing is evaluated or recorded.
+        if not isinstance(values, dict):
+            p = numpy.array(values, dtype=float)
+            assert p.shape == (len(self.names),)
+            return p
+        p = numpy.array([self.mapped[i] if i in self.mapped else P.Value() for i, P in enumerate(self.parameters)])
+        for name, value in values.iteritems():
+            p[self.names.index(name)] = value
+        return p
+
+    def stimulusMagnitude(self, volts):
+        # volts may be a Parameter, Expression or quantity; a bare number is assumed in preferred units
+        return parameter.mu(volts, self.preferred.voltage)
+
+    def evaluate(self, p=None, volts=None):
+        # rates by name; p in the parameters' own units, volts in preferred voltage units
+        if p is None:
+            p = self.values()
+        names = dict(self.methods)
+        names.update(zip(self.names, (numpy.asarray(p) * self.factors).tolist()))
+        if self.stimulus is not None and volts is not None:
+            names[self.stimulus] = volts * self.stimulusFactor
+        for name, code in self.expressions:
+            names[name] = eval(code, names)
+        return names
+
+    def Q(self, p=None, volts=None):
+        # Q without units, in preferred rate units
+        names = self.evaluate(p, volts)
+        Q = numpy.zeros([self.s, self.s])
+        for row, col, name in self.entries:
+            Q[row, col] = names[name]
+        if self.rateScale != 1.:
+            Q *= self.rateScale
+        for row, col, value in self.constants:
+            Q[row, col] = value
+        numpy.fill_diagonal(Q, -Q.sum(axis=1))
+        return Q
+
+    def Qs(self, p=None, volts=None):
+        # Stacked Q (nV x s x s) for an array of voltages from a single vectorized evaluation of the rates
+        volts = numpy.asarray(volts, dtype=float).ravel()
+        names = self.evaluate(p, volts)
+        Q = numpy.zeros([len(volts), self.s, self.s])
+        for row, col, name in self.entries:
+            Q[:, row, col] = names[name]  # rates that do not depend on voltage broadcast
+        if self.rateScale != 1.:
+            Q *= self.rateScale
+        for row, col, value in self.constants:
+            Q[:, row, col] = value
+        diagonal = numpy.arange(self.s)
+        Q[:, diagonal, diagonal] = -Q.sum(axis=2)
+        return Q
+
+    def jacobian(self, p=None, volts=None):
+        # Q and its derivatives dQ, with dQ[..., i, j, k] the derivative of Q[..., i, j] with respect to
+        # parameter self.names[k] in its own units (for the stimulus: volts, in preferred voltage units).
+        # volts may be a number or an array; the derivatives are computed by vectorized forward-mode.
+        if p is None:
+            p = self.values()
+        names = dict(self.methods)
+        names.update({"exp": dual.exp, "log": dual.log, "sin": dual.sin, "cos": dual.cos,
+                      "tan": dual.tan, "log10": dual.log10})
+        names.update(zip(self.names, dual.seed((numpy.asarray(p) * self.factors).tolist(), self.factors)))
+        shape = ()
+        if self.stimulus is not None and volts is not None:
+            volts = numpy.asarray(volts, dtype=float)
+            shape = volts.shape
+            dx = numpy.zeros(shape + (len(self.names),))
+            dx[..., self.names.index(self.stimulus)] = self.stimulusFactor
+            names[self.stimulus] = dual.Dual(volts * self.stimulusFactor, dx)
+        for name, code in self.expressions:
+            names[name] = eval(code, names)
+        Q = numpy.zeros(shape + (self.s, self.s))
+        dQ = numpy.zeros(shape + (self.s, self.s, len(self.names)))
+        for row, col, name in self.entries:
+            rate = names[name]
+            if isinstance(rate, dual.Dual):
+                Q[..., row, col] = rate.x
+                dQ[..., row, col, :] = rate.dx
+            else:  # rate does not depend on the parameters
+                Q[..., row, col] = rate
+        if self.rateScale != 1.:
+            Q *= self.rateScale
+            dQ *= self.rateScale
+        for row, col, value in self.constants:
+            Q[..., row, col] = value
+        diagonal = numpy.arange(self.s)
+        Q[..., diagonal, diagonal] = -Q.sum(axis=-1)
+        dQ[..., diagonal, diagonal, :] = -dQ.sum(axis=-2)
+        return Q, dQ
+
+    def A(self, p, volts, dt):
+        # transition matrices expm(dt*Q) for a voltage (s x s) or an array of voltages (nV x s x s);
+        # a pure function of p, volts and dt (in preferred time units), safe to call from many threads
+        if numpy.ndim(volts) == 0:
+            return scipy.linalg.expm(dt * self.Q(p, volts))
+        return numpy.array([scipy.linalg.expm(dt * Q) for Q in self.Qs(p, volts)])
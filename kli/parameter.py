@@ -4,7 +4,23 @@ import copy
 import pint
 import ad
 
-u = pint.UnitRegistry()  # Need to import u in every module that uses units
+class LazyRegistry(object):
+    # Stands in for the one pint.UnitRegistry shared by every module; the registry, whose
+    # definitions are slow to parse, is only created the first time a unit is used
+    def __init__(self):
+        self.registry = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):  # e.g. copy and pickle probing for special methods
+            raise AttributeError(name)
+        if self.registry is None:
+            self.registry = pint.UnitRegistry()
+        return getattr(self.registry, name)
+
+    def __call__(self, *args, **kw):
+        return self.__getattr__('parse_expression')(*args, **kw)
+
+u = LazyRegistry()  # Need to import u in every module that uses units
 
 
 def v(x):  # Returns value (possibly with units) of a parameter or expression
@@ -38,6 +54,8 @@ def setUnit(x, units):
 
 
 class Parameter(object):
+    structure = 0  # counts changes of name and units, see Space.structure
+    version = 0  # counts assignments of the value, see Space.version
     def __init__(self, name, value=1., units='dimensionless', default=None, log=False):
         self.name = name
         # must define values so that setting routines work
@@ -80,6 +98,7 @@ class Parameter(object):
             pass
 
     def remap(self, mappedValue):
+        self.structure += 1  # kernels keep the magnitudes of remapped parameters from compile time
         self.remapped = True
         self.mappedValue = mappedValue
         if self.useAD:
@@ -95,6 +114,8 @@ class Parameter(object):
                 pass
 
     def unmap(self):
+        if self.remapped:
+            self.structure += 1
         self.remapped = False
         self.mappedValue = None
 
@@ -107,9 +128,13 @@ class Parameter(object):
     def rename(self, name):
         self.name = name
         self.integrity()
+        self.structure += 1
 
     def setUnits(self, units):
-        self.value = setUnit(self.value, units)
+        value = setUnit(self.value, units)
+        if value.units != self.value.units:
+            self.structure += 1
+        self.value = value
         self.default = setUnit(self.default, units)
         self.bounds = setUnit(self.bounds, units)
 
@@ -141,7 +166,8 @@ class Parameter(object):
         if not units == None:
             self.setUnits(units)
         self.value._magnitude = value
-        self.ADvalue = ad.adnumber(value, self.name)
+        self._ADvalue = None  # built on first use by ADvalue
+        self.version += 1
         self.checkValue()  # a weak version of integrity()
 
     def assignLog(self, logValue, units=None):
@@ -149,12 +175,18 @@ class Parameter(object):
             self.setUnits(units)
         if self.useLog:
             self.value._magnitude = numpy.exp(logValue)
-            self.ADvalue = ad.adnumber(numpy.exp(logValue), self.name)
         else:
             self.value._magnitude = logValue
-            self.ADvalue = ad.adnumber(logValue, self.name)
+        self._ADvalue = None  # built on first use by ADvalue
+        self.version += 1
         self.checkValue()  # a weak version of integrity()
 
+    @property
+    def ADvalue(self):  # ad.adnumber is only needed (and only built) when useAD is on
+        if self._ADvalue is None:
+            self._ADvalue = ad.adnumber(self.value._magnitude, self.name)
+        return self._ADvalue
+
     def setDefault(self, default):
         self.default._magnitude = default
         self.integrity()
@@ -313,6 +345,67 @@ class Space(object):
             self.eDict.update(i.getExpressions())
         self.integrity()
 
+    def version(self):
+        # grows whenever a parameter of the space is assigned (once per assignVector); models that cache
+        # what they compute from the values (e.g. engine.FlatStepProtocol) compare it to refresh
+        return sum(P.version for P in self.pDict.itervalues())
+
+    def structure(self):
+        # grows whenever a name, the units of a parameter or an expression of the space changes;
+        # things compiled from the space (e.g. a RateKernel) are stale once it has grown
+        return (sum(P.structure for P in self.pDict.itervalues()) +
+                sum(E.structure for E in self.eDict.itervalues()))
+
+    # Packed parameter vectors: the values of many parameters as one float64 vector.  With useLog=True
+    # each parameter is in its own scaling (log for log parameters, linear otherwise), as in assignLog.
+    def names(self, free=True):
+        # sorted names; free=True leaves out remapped parameters (e.g. VOLTAGE, set by the protocol)
+        return sorted(key for key, P in self.pDict.iteritems() if not (free and P.remapped))
+
+    def packingLog(self, names):
+        return numpy.array([self.pDict[name].useLog for name in names], dtype=bool)
+
+    def pack(self, useLog=True, names=None):
+        if names is None:
+            names = self.names()
+        x = numpy.array([self.pDict[name].Value() for name in names], dtype=numpy.float64)
+        if useLog:
+            isLog = self.packingLog(names)
+            x[isLog] = numpy.log(x[isLog])
+        return x
+
+    def packBounds(self, useLog=True, names=None):
+        if names is None:
+            names = self.names()
+        lower = numpy.array([self.pDict[name].Lower() for name in names], dtype=numpy.float64)
+        upper = numpy.array([self.pDict[name].Upper() for name in names], dtype=numpy.float64)
+        if useLog:
+            isLog = self.packingLog(names)
+            with numpy.errstate(divide='ignore'):  # log(0) = -inf is the right lower bound
+                lower[isLog] = numpy.log(lower[isLog])
+                upper[isLog] = numpy.log(upper[isLog])
+        return lower, upper
+
+    def assignVector(self, x, useLog=True, names=None):
+        # assigns every value at once: checks all bounds before changing anything, then counts one new version
+        # of each parameter assigned
+        if names is None:
+            names = self.names()
+        x = numpy.asarray(x, dtype=numpy.float64)
+        assert x.shape == (len(names),)
+        values = x.copy()
+        if useLog:
+            isLog = self.packingLog(names)
+            values[isLog] = numpy.exp(x[isLog])
+        lower, upper = self.packBounds(False, names)
+        assert numpy.all(lower <= values) and numpy.all(values <= upper)
+        assert numpy.all(values[self.packingLog(names)] > 0.)
+        for name, value in zip(names, values.tolist()):
+            P = self.pDict[name]
+            P.value._magnitude = value
+            P._ADvalue = None
+            P.version += 1
+
     def onAD(self):
         for P in self.pDict.itervalues():
             P.onAD()
@@ -363,32 +456,30 @@ class Space(object):
         return s
 
     def append(self, x):
-        keys = pNameSet(self)
-        newkeys = pNameSet(x)
-        doubles = set.intersection(keys, newkeys)
-        for d in doubles:
-            if isinstance(x, Space):
-                # parameter with same name: must have same identity
-                assert (self.pDict[d] is x.pDict[d])
-            else:
-                # parameter with same name: must have same identity
-                assert (self.pDict[d] is x)
-        keys = eNameSet(self)
-        newkeys = eNameSet(x)
-        doubles = set.intersection(keys, newkeys)
-        for d in doubles:
-            if isinstance(x, Space):
-                # parameter with same name: must have same identity
-                assert (self.eDict[d] is x.eDict[d])
-            else:
-                # parameter with same name: must have same identity
-                assert (self.eDict[d] is x)
+        # Only the appended names are checked, so building a Space is linear in its size
+        newP, newE = self.check(x)
+        self.pDict.update(newP)
+        self.eDict.update(newE)
+
+    def check(self, x):
+        # the parameters and expressions x would add, asserting they agree with the Space; changes nothing
         if isinstance(x, Space):
-            self.pDict.update(x.pDict)
-            self.eDict.update(x.eDict)
+            newP = x.pDict
+            newE = x.eDict
         else:
-            self.pDict[x.name] = x
-        self.integrity()
+            newP = {x.name: x}
+            newE = {}
+        for key, value in newP.iteritems():
+            # parameter with same name: must have same identity
+            assert (self.pDict.get(key, value) is value)
+            assert (isinstance(value, Parameter))
+            assert (key == value.name)
+        for key, value in newE.iteritems():
+            # expression with same name: must have same identity
+            assert (self.eDict.get(key, value) is value)
+            assert (isinstance(value, Expression))
+            assert (key == value.name)
+        return newP, newE
 
     def integrity(self):
         # make sure parameters have the right names
@@ -406,7 +497,7 @@ def pNameSet(x):
     if isinstance(x, Space):
         return set(x.pDict.iterkeys())
     if isinstance(x, Parameter):
-        return set(x.name)
+        return {x.name}
     else:
         return set()
 
@@ -415,7 +506,7 @@ def eNameSet(x):
     if isinstance(x, Space):
         return set(x.eDict.iterkeys())
     if isinstance(x, Expression):
-        return set(x.name)
+        return {x.name}
     else:
         return set()
 
@@ -425,6 +516,7 @@ def emptySpace():
 
 
 class Expression(object):
+    structure = 0  # counts changes of name, expression and parameters, see Space.structure
     def __init__(self, name, expr, items):
         self.name = name
         self.expr = expr
@@ -475,6 +567,7 @@ class Expression(object):
         if not P is None:
             self.PS = P
         self.integrity()
+        self.structure += 1
 
     def evaluate(self):
         if self.useAD:
@@ -6,8 +6,6 @@ import parameter
 import scipy
 import scipy.linalg
 from parameter import u
-import matplotlib
-import matplotlib.pyplot as pyplot
 import engine
 
 # default_dt = parameter.Parameter("dt",0.05,"ms",log=True)
@@ -65,20 +63,72 @@ class singleChannelPatch(object):
         else:
             assert (False)  # Take this out after implementing noise
 
+    def kernel(self, voltageUnit=None, timeUnit=None):
+        # compiled rates of the channel with VOLTAGE as the stimulus
+        return self.ch.getKernel(self.VOLTAGE,
+                                 'mV' if voltageUnit is None else voltageUnit,
+                                 'ms' if timeUnit is None else timeUnit)
+
+    def makeQM(self, volts, voltageUnit=None, timeUnit=None):
+        # Q without units (M is for magnitude) in 1/timeUnit
+        K = self.kernel(voltageUnit, timeUnit)
+        if voltageUnit is None:  # volts carries its own units
+            volts = K.stimulusMagnitude(volts)
+        return K.Q(volts=volts)
+
+    def makeQMs(self, volts, voltageUnit=None, timeUnit=None):
+        # Stacked Q without units (nV x s x s) for a sequence of voltages, evaluated in one call
+        if voltageUnit is None:  # each element of volts carries its own units
+            volts = [self.kernel(voltageUnit, timeUnit).stimulusMagnitude(v) for v in volts]
+        return self.ch.makeQs(self.VOLTAGE, volts,
+                              'mV' if voltageUnit is None else voltageUnit,
+                              'ms' if timeUnit is None else timeUnit)
+
+    def jacobianQ(self, volts, voltageUnit=None, timeUnit=None):
+        # Q, dQ/dparameter for one voltage or an array of voltages, and the parameter names
+        if voltageUnit is None:  # volts carries its own units
+            volts = self.kernel(voltageUnit, timeUnit).stimulusMagnitude(volts)
+        return self.ch.jacobianQ(self.VOLTAGE, volts,
+                                 'mV' if voltageUnit is None else voltageUnit,
+                                 'ms' if timeUnit is None else timeUnit)
+
+    # pureQ and pureA neither remap VOLTAGE nor evaluate Expressions: they depend only on their arguments,
+    # so several voltages or parameter sets can be evaluated concurrently.  p is a vector ordered as
+    # self.kernel().names or a {name: value} dict (missing names take current values, or for remapped
+    # parameters those at compile time), each value in the parameter's own units; volts (a number or an
+    # array) are in voltageUnit, dt in timeUnit.
+    def pureQ(self, p, volts, voltageUnit='mV', timeUnit='ms'):
+        K = self.kernel(voltageUnit, timeUnit)
+        p = K.vector(p)
+        return K.Q(p, volts) if np.ndim(volts) == 0 else K.Qs(p, volts)
+
+    def pureA(self, p, volts, dt, voltageUnit='mV', timeUnit='ms'):
+        K = self.kernel(voltageUnit, timeUnit)
+        return K.A(K.vector(p), volts, dt)
+
     def makeQ(self, volts, voltageUnit=None):
-        if voltageUnit is not None:
-            volts = volts*parameter.u.__getattr__(voltageUnit)
-        self.VOLTAGE.remap(volts)
-        return self.ch.makeQ()
+        return np.matrix(self.makeQM(volts, voltageUnit)) / u.millisecond
 
     def makeA(self, volts, dt, voltageUnit=None, timeUnit=None):
-        Q = self.makeQ(volts, voltageUnit)
-        if timeUnit is not None:
-            dt = dt * parameter.u.__getattr__(timeUnit)
+        Q = self.makeQM(volts, voltageUnit, timeUnit)
+        if timeUnit is None:  # dt carries its own units
+            dt = parameter.mu(dt, self.kernel(voltageUnit, timeUnit).preferred.time)
         A = scipy.linalg.expm(dt * Q)
         self.assertSumOfRowsIsRowOfOnes(A)
         return A
 
+    def makeAs(self, volts, dt, voltageUnit=None, timeUnit=None):
+        # One A matrix per voltage; the generators come from a single vectorized evaluation
+        Qs = self.makeQMs(volts, voltageUnit, timeUnit)
+        if timeUnit is None:  # dt carries its own units
+            dt = parameter.mu(dt, self.kernel(voltageUnit, timeUnit).preferred.time)
+        As = []
+        for Q in Qs:
+            A = scipy.linalg.expm(dt * Q)
+            self.assertSumOfRowsIsRowOfOnes(A)
+            As.append(A)
+        return As
+
     def assertSumOfRowsIsRowOfOnes(self,A):
         # assert sum of rows is row of ones to tolerance
         tol = 1e-7
@@ -86,8 +136,7 @@ class singleChannelPatch(object):
         assert (np.amax(np.sum(A, axis=1)) < 1. + tol)
 
     def equilibrium(self, volts, voltageUnit=None, timeUnit=None):
-        Qunits = self.makeQ(volts, voltageUnit)
-        Q = parameter.mu(Qunits, '1/'+timeUnit)
+        Q = np.matrix(self.makeQM(volts, voltageUnit, timeUnit))
         (V, D) = np.linalg.eig(Q.T)  # eigenspace
         imin = np.argmin(np.absolute(V))  # index of 0 eigenvalue
         eigvect0 = D[:, imin]  # corresponding eigenvector
@@ -105,8 +154,25 @@ class singleChannelPatch(object):
         assert False  # Should never reach this point
 
 
-khhPatch = singleChannelPatch(channel.khh, channel.VOLTAGE)
-SP = StepProtocol(khhPatch, [-65*u.mV, -20*u.mV], [np.inf, 10*u.ms])
-FS = SP.flatten(5)
-FS.sim(10)
-testedlike = FS.like()
+
+class Demo(object):
+    # A step protocol on the canonical khh channel, simulated for 10 repetitions
+    def __init__(self):
+        canonical = channel.canonical()
+        self.khhPatch = singleChannelPatch(canonical.khh, canonical.VOLTAGE)
+        self.SP = StepProtocol(self.khhPatch, [-65*u.mV, -20*u.mV], [np.inf, 10*u.ms])
+        self.FS = self.SP.flatten(5)
+        self.FS.sim(10)
+        self.testedlike = self.FS.like()
+
+
+demoModels = None
+
+
+def demo():
+    # Built on first call (not at import, which used to run this simulation), then shared
+    global demoModels
+    if demoModels is None:
+        demoModels = Demo()
+    return demoModels
+
@@ -0,0 +1,35 @@
+import numpy
+
+# Philox4x32-10 (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", SC11), a counter-based
+# generator: the output is a pure function of a 128-bit counter and a 64-bit key, so any draw can be
+# computed directly, in any order.  Words are held in uint64 arrays so that 32 x 32-bit products fit.
+M0 = numpy.uint64(0xD2511F53)
+M1 = numpy.uint64(0xCD9E8D57)
+W0 = numpy.uint64(0x9E3779B9)  # key increments (Weyl sequence)
+W1 = numpy.uint64(0xBB67AE85)
+MASK = numpy.uint64(0xFFFFFFFF)
+SHIFT = numpy.uint64(32)
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1, rounds=10):
+    # c0..c3: arrays (or numbers) of counter words, k0, k1: key words; returns the 4 output words
+    c0, c1, c2, c3 = [numpy.asarray(c, dtype=numpy.uint64) for c in (c0, c1, c2, c3)]
+    k0 = numpy.uint64(k0)
+    k1 = numpy.uint64(k1)
+    for r in range(rounds):
+        p0 = M0 * c0
+        p1 = M1 * c2
+        c0, c1, c2, c3 = ((p1 >> SHIFT) ^ c1 ^ k0, p1 & MASK, (p0 >> SHIFT) ^ c3 ^ k1, p0 & MASK)
+        k0 = (k0 + W0) & MASK
+        k1 = (k1 + W1) & MASK
+    return c0, c1, c2, c3
+
+
+def uniforms(key, replicates, first, m):
+    # doubles in (0, 1): draws first, ..., first+m-1 of each replicate, as an array len(replicates) x m.
+    # Draw d of replicate i uses the counter (d, 0, low word of i, high word of i); 53 bits per double.
+    i = numpy.asarray(replicates, dtype=numpy.uint64)[:, numpy.newaxis]
+    d = numpy.arange(first, first + m, dtype=numpy.uint64)[numpy.newaxis, :]
+    a, b, c, e = philox4x32(d + 0 * i, 0, i & MASK, i >> SHIFT, key & 0xFFFFFFFF, key >> 32)
+    return ((a >> numpy.uint64(5)).astype(float) * 67108864. + (b >> numpy.uint64(6)).astype(float) + .5) \
+        / 9007199254740992.
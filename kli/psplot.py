@@ -5,6 +5,7 @@ import matplotlib.pylab as plt
 import matplotlib
 import star
 import simple
+import toy
 import pickle
 import time
 
@@ -73,17 +74,17 @@ def compute_alt(B, Balt):
             return np.inf
     return S.r_star(confidence_level())
 
-def compute_one(p, n, n_alt_plus, n_alt_minus,):
-    B = simple.Simple(n=n, p=p).flatten()
-    Bplus = simple.Simple(n=n_alt_plus, p=p).flatten()
-    Bminus = simple.Simple(n=n_alt_minus, p=p).flatten()
+def compute_one(p, n, n_alt_plus, n_alt_minus, crn=None):  # crn: a toy.CommonRandomNumbers shared by the grid
+    B = simple.Simple(n=n, p=p).flatten(seed=crn)
+    Bplus = simple.Simple(n=n_alt_plus, p=p).flatten(seed=crn)
+    Bminus = simple.Simple(n=n_alt_minus, p=p).flatten(seed=crn)
     print "Computing Plus Alternative"
     SPlus = compute_alt(B, Bplus)
     print "Computing Minus Alternative"
     SMinus = compute_alt(B, Bminus)
     return SPlus, SMinus
 
-def compute(ps,ns,ns_alt_plus,ns_alt_minus,reps,fname):
+def compute(ps,ns,ns_alt_plus,ns_alt_minus,reps,fname,crn=False):
     dim = (reps, len(ps), len(ns))
     P = np.zeros(dim)
     N = np.zeros(dim)
@@ -93,13 +94,15 @@ def compute(ps,ns,ns_alt_plus,ns_alt_minus,reps,fname):
     rStarMinus = np.zeros(dim)
     k = 0
     initial = time.time()
+    # with crn, each repetition shares its random numbers across the whole grid
+    crns = [toy.CommonRandomNumbers() if crn else None for r in range(reps)]
     for pi, p in enumerate(ps):
         for ni, n in enumerate(ns):
             for r in range(reps):
                 start = time.time()
                 k = k + 1
                 print "Computing (r, p, n) =", r, p, n, "(", r, pi, ni, "), of", P.shape
-                rstar_plus1, rstar_minus1 = compute_one(p,n,ns_alt_plus[ni],ns_alt_minus[ni])
+                rstar_plus1, rstar_minus1 = compute_one(p,n,ns_alt_plus[ni],ns_alt_minus[ni],crns[r])
                 P[r, pi, ni] = p
                 N[r, pi, ni] = n
                 NPlus[r, pi, ni] = ns_alt_plus[ni]
@@ -1,9 +1,7 @@
 __author__ = 'sean'
 import numpy
 import toy
-import matplotlib.pylab as plt
-import matplotlib
-import scipy
+import scipy.stats
 
 class Repetitions(toy.FlatToy):
     def __init__(self, base, rReps, name=None):
@@ -30,6 +28,9 @@ class Repetitions(toy.FlatToy):
     def setUpExperiment(self, base, kw):
         pass
 
+    def getExperiment(self):
+        return {'base': self.base.getExperiment(), 'rReps': self.rReps}
+
     def _reseed(self, seed=None):
         self.base._reseed(seed)
 
@@ -57,22 +58,21 @@ class Repetitions(toy.FlatToy):
     def get_data(self, mReps=True):
         mReps = self.process_mReps(mReps)
         self.extend_data(mReps)
-        data = []
-        for r in range(int(mReps/self.rReps)):
-            datum = [self.base.data[r*self.rReps + d] for d in range(self.rReps)]
-            data.append(datum)
-        return data
+        len_data = int(mReps/self.rReps)
+        return self.base.data[0:len_data*self.rReps].reshape(len_data, self.rReps)  # a view of the base data
 
-    def likelihoods(self, trueModel=None, selection=True, bootstrap=False):
+    def likelihoods(self, trueModel=None, selection=True, bootstrap=False, rows=None):
         if trueModel is None:
             trueModel = self
         if selection is True:
             selection = trueModel.selection
-        baselikes = self.extend_likes(trueModel, selection)
+        baselikes = self.extend_likes(trueModel, selection).view()
         assert trueModel.rReps == self.rReps
-        likes = []
-        for selectum in selection.choice:
-            likes.append(sum([baselikes[s] for s in selectum]))
+        choice = selection.choice if rows is None else selection.choice[rows]
+        # adds one column of selected base likelihoods at a time: the same order as summing each row in turn
+        likes = baselikes[choice[:, 0]]
+        for r in range(1, choice.shape[1]):
+            likes += baselikes[choice[:, r]]
         return likes
 
     def _debug(self, flag=None):
@@ -204,6 +204,8 @@ class Repetitions(toy.FlatToy):
         return self.inversePrCurve(rMinus, pMinus, C)
 
     def rMinus2Plus_plot(self, alt, trueModel, rMinus, pMinus, rPlus, C=0.95):
+        plt = toy.pyplot()
+        import matplotlib.patches
         if trueModel is None:
             trueModel = self
         r1 = max(2, int(rMinus))
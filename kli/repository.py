@@ -1,24 +1,493 @@
-class TableOfModels(object):
+import atexit
+import fcntl
+import hashlib
+import heapq
+import itertools
+import numbers
+import os
+import shutil
+import struct
+import tempfile
+import weakref
+import numpy
+
+
+def columnType(value):  # float64 or int64 for numbers, object for anything else (e.g. trajectories)
+    if isinstance(value, (bool, numpy.bool_)):
+        return object
+    if isinstance(value, numbers.Integral):
+        return numpy.int64
+    if isinstance(value, numbers.Real):
+        return numpy.float64
+    return object
+
+
+class Column(object):
+    # Growable typed array.  Appends are amortized O(1) (capacity doubles), slices of the filled part
+    # are views rather than copies and trim only changes the length.  A view aliases the buffer, so
+    # values overwritten after a trim show through views taken before it.
+    def __init__(self, dtype=None, capacity=16):
+        self.dtype = dtype  # if None, chosen from the first value appended
+        self.buffer = None if dtype is None else numpy.empty(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.n = 0
+
+    def reserve(self, n):  # makes room for n values in total without reallocating
+        if self.buffer is not None and n <= len(self.buffer):
+            return
+        capacity = self.capacity
+        while capacity < n:
+            capacity *= 2
+        self.capacity = capacity
+        if self.buffer is None:
+            return
+        buffer = numpy.empty(capacity, dtype=self.dtype)
+        buffer[:self.n] = self.buffer[:self.n]
+        self.buffer = buffer
+
+    def promote(self, value):  # widens int64 to float64, or numbers to object, when value does not fit
+        dtype = columnType(value)
+        if self.dtype is None:
+            self.dtype = dtype
+            self.buffer = numpy.empty(self.capacity, dtype=dtype)
+        elif dtype is not self.dtype and self.dtype is not object:
+            if dtype is object:
+                self.dtype = object
+            elif self.dtype is numpy.int64:  # dtype is float64; a float64 column holds ints as they are
+                self.dtype = numpy.float64
+            else:
+                return
+            self.buffer = self.buffer.astype(self.dtype)
+
+    def append(self, value):
+        if self.dtype is None or (self.dtype is not object and columnType(value) is not self.dtype):
+            self.promote(value)
+        if self.n == len(self.buffer):
+            self.reserve(2 * self.n)
+        self.buffer[self.n] = value
+        self.n += 1
+
+    def extend(self, values):
+        if isinstance(values, numpy.ndarray) and values.ndim == 1 and values.dtype.kind in 'iuf':
+            if len(values) == 0:
+                return
+            self.promote(values.dtype.type(0))  # numeric arrays are copied in one step
+            self.reserve(self.n + len(values))
+            self.buffer[self.n:self.n + len(values)] = values
+            self.n += len(values)
+            return
+        for value in values:
+            self.append(value)
+
+    def trim(self, n=0):
+        self.n = min(self.n, max(n, 0))
+
+    def view(self):
+        if self.buffer is None:
+            return numpy.empty(0)
+        return self.buffer[:self.n]
+
+    def nbytes(self):  # memory held, including spare capacity (for object columns, only the references)
+        return 0 if self.buffer is None else self.buffer.nbytes
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None):
+        return self.view() if dtype is None else self.view().astype(dtype)
+
+    def __str__(self):
+        return str(self.view())
+
+    def __repr__(self):
+        return 'Column(%s)' % repr(self.view())
+
+
+clock = itertools.count()  # orders uses of table entries, for least-recently-used eviction
+
+
+class LikelihoodCache(object):
+    # Accounts for the entries of every TableOfModels.  With a budget (in bytes), the least recently
+    # used entries are evicted when the total exceeds it: dropped (likelihoods are recomputed from the
+    # data when needed again) or, with spill, saved to disk and reloaded on their next use.
+    def __init__(self, budget=None, spill=None):
+        self.tables = weakref.WeakSet()
+        self.uses = []  # with a budget, heap of (clock tick, table, key), weakly; outdated uses are skipped
+        self.limit = 64  # size at which the heap is rebuilt without outdated uses
+        self.sizes = {}  # id of an entry -> (weak reference, bytes it held when last accounted)
+        self.total = 0  # bytes held by the accounted entries
+        self.directory = None
+        self.configure(budget, spill)
+
+    def configure(self, budget=None, spill=None):  # spill: None, a directory, or True for a temporary one
+        self.budget = budget
+        self.spill = spill
+        self.compact()  # uses are only kept with a budget; the tables' last uses stand for them
+        self.enforce()
+
+    def spillDirectory(self):
+        if self.spill is True:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix='kli-likes-')
+                atexit.register(shutil.rmtree, self.directory, True)
+            return self.directory
+        return self.spill
+
+    def nbytes(self):
+        return sum(T.nbytes() for T in list(self.tables))
+
+    def account(self, entry):  # brings the total up to date with an entry, which may have grown
+        ref, size = self.sizes.get(id(entry), (None, 0))
+        if ref is None:
+            ref = weakref.ref(entry, lambda ref, i=id(entry): self.forget(i))
+        self.sizes[id(entry)] = (ref, entry.nbytes())
+        self.total += entry.nbytes() - size
+
+    def forget(self, i):  # an entry that died or left its table
+        ref, size = self.sizes.pop(i, (None, 0))
+        self.total -= size
+
+    def use(self, T, key, tick):
+        if self.budget is None:  # nothing is evicted, so the order of uses is not needed
+            return
+        heapq.heappush(self.uses, (tick, weakref.ref(T), weakref.ref(key)))
+        if len(self.uses) > self.limit:
+            self.compact()
+
+    def compact(self):  # rebuilds the heap from the last use of each entry, or empties it without a budget
+        self.uses = []
+        if self.budget is not None:
+            self.uses = [(tick, weakref.ref(T), weakref.ref(key)) for T in list(self.tables)
+                         for key, tick in T.used.items() if key in T.table]
+            heapq.heapify(self.uses)
+        self.limit = 2 * len(self.uses) + 64
+
+    def enforce(self, keep=None):  # keep: an entry in use, never evicted
+        if keep is not None:
+            self.account(keep)
+        if self.budget is None:
+            return
+        kept = []
+        while self.total > self.budget and len(self.uses) > 0:
+            use = heapq.heappop(self.uses)  # the least recent use
+            tick, T, key = use[0], use[1](), use[2]()
+            if T is None or key is None or key not in T.table or T.used.get(key) != tick:
+                continue  # the table or the model went, the entry was evicted, or it was used again since
+            if T.table[key] is keep:
+                kept.append(use)
+                continue
+            T.evict(key)
+        for use in kept:
+            heapq.heappush(self.uses, use)
+
+    def usage(self):
+        # (true model, Fingerprint of a model, bytes in memory, bytes on disk); None for the true model's data
+        rows = []
+        for T in list(self.tables):
+            owner = T.owner()
+            if owner is None:
+                continue
+            if T.dtype is not None:  # tables of likelihoods; each true model reports its data once
+                rows.append((owner, None, owner.data.nbytes(), 0))
+            for model in set(T.table.keys()) | set(T.spilled.keys()):
+                entry = T.table.get(model)
+                fname = T.spilled.get(model)
+                rows.append((owner, model, 0 if entry is None else entry.nbytes(),
+                             0 if fname is None else os.path.getsize(fname)))
+        return rows
+
+    def report(self):
+        total = 0
+        for owner, model, memory, disk in self.usage():
+            name = 'data' if model is None else str(model)
+            print "%s | %s: %d bytes in memory, %d bytes on disk" % (owner.str_name(), name, memory, disk)
+            total += memory
+        print "Total:", total, "bytes in memory; budget:", self.budget
+        return total
+
+
+cache = LikelihoodCache()
+
+
+spillFiles = {}  # file of an evicted entry -> weak references to its table and key, which remove it when they go
+
+
+def spillFile(directory, T, key, values):  # saves values to a new file that goes with T or key
+    fd, fname = tempfile.mkstemp(suffix='.npy', dir=directory)
+    f = os.fdopen(fd, 'wb')
+    numpy.save(f, values)
+    f.close()
+    spillFiles[fname] = (weakref.ref(T, lambda ref: removeSpill(fname)),
+                         weakref.ref(key, lambda ref: removeSpill(fname)))
+    return fname
+
+
+def removeSpill(fname):
+    if spillFiles.pop(fname, None) is not None:
+        try:
+            os.remove(fname)
+        except OSError:  # e.g. a temporary directory removed at exit
+            pass
+
+
+atexit.register(lambda: [removeSpill(fname) for fname in spillFiles.keys()])
+
+
+def canonical(x):  # a repr that depends only on content, or None for objects without one
+    if x is None or isinstance(x, (bool, str, unicode)):
+        return repr(x)
+    if isinstance(x, (int, long)):
+        return '%d' % x  # no L suffix: 2 and 2L are the same number
+    if isinstance(x, float):
+        return repr(x + 0.)  # shortest repr that round-trips; -0. and 0. are the same
+    if isinstance(x, numpy.generic):
+        return canonical(x.item())
+    if isinstance(x, numpy.ndarray):
+        content = canonical(x.tolist())
+        return None if content is None else 'array(%s,%s)' % (x.dtype.str, content)
+    if isinstance(x, (tuple, list)):
+        parts = [canonical(y) for y in x]
+        return None if None in parts else '(' + ','.join(parts) + ')'
+    if isinstance(x, dict):
+        parts = [canonical(item) for item in sorted(x.items())]
+        return None if None in parts else '{' + ','.join(parts) + '}'
+    return None
+
+
+HEADER = 128  # bytes of the .npy headers the store writes: room for any length, so a longer array only rewrites it
+stateRecord = numpy.dtype([('n', '<i8'), ('pos', '<i8'), ('has_gauss', '<i8'), ('cached_gaussian', '<f8'),
+                           ('keys', '<u4', 624)])  # a RandomState (MT19937) state after n replicates
+
+
+def npyHeader(dtype, n):  # header of a 1-d .npy file of n values, padded to HEADER bytes
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (numpy.lib.format.dtype_to_descr(dtype), n)
+    return numpy.lib.format.magic(1, 0) + struct.pack('<H', HEADER - 10) + header.ljust(HEADER - 11) + '\n'
+
+
+class DiskStore(object):
+    # Content-addressed store of simulated data and likelihoods that persists between sessions.
+    # Data are keyed by the model's class, its experiment and the initial state of its RNG; likelihoods
+    # by the likelihood model and the key of the data.  Each key holds the first n replicates as an
+    # .npy file, read memory-mapped and grown by appending; data also keep the RNG states after the
+    # lengths they were simulated to, so a model continues exactly where the stored data it uses stop.
+    # Models whose experiment has no content-based repr (e.g. a patch) or whose data are not numbers
+    # are not stored.  Files are grown under an exclusive lock (fcntl.flock), so several processes may
+    # share a directory; new or rewritten files are renamed into place whole.
+    def __init__(self, directory=None):
+        self.configure(directory)
+
+    def configure(self, directory=None):  # None turns the store off
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def dataKey(self, model):
+        if self.directory is None or model.debugFlag:
+            return None
+        return dataDigest(model)
+
+    def likesKey(self, model, trueModel):
+        dataKey = self.dataKey(trueModel)
+        if dataKey is None or model.fingerprint.digest is None:
+            return None
+        return digest('likes', model.fingerprint.digest, dataKey)
+
+    def path(self, key, kind):
+        return os.path.join(self.directory, key + '.' + kind)
+
+    def read(self, key, kind):  # stored replicates (memory-mapped), or None
+        if key is None or not os.path.exists(self.path(key, kind + '.npy')):
+            return None
+        return numpy.load(self.path(key, kind + '.npy'), mmap_mode='r')
+
+    def readState(self, key, n):  # (m, RNG state after m replicates) for the largest stored m <= n, or (0, None)
+        try:
+            f = open(self.path(key, 'data.states'), 'rb')
+        except IOError:
+            return 0, None
+        fcntl.flock(f, fcntl.LOCK_SH)  # no record is read half written
+        records = numpy.fromfile(f, dtype=stateRecord)
+        f.close()
+        records = records[records['n'] <= n]
+        if len(records) == 0:
+            return 0, None
+        r = records[numpy.argmax(records['n'])]
+        return int(r['n']), ('MT19937', r['keys'].copy(), int(r['pos']), int(r['has_gauss']),
+                             float(r['cached_gaussian']))
+
+    def write(self, key, kind, values, state=None):  # state: a RandomState's, after the values
+        values = numpy.asarray(values)
+        if key is None or values.dtype.kind not in 'iuf':
+            return
+        self.append(self.path(key, kind + '.npy'), values)
+        if state is not None:
+            record = numpy.zeros(1, dtype=stateRecord)
+            record['n'], record['keys'], record['pos'], record['has_gauss'], record['cached_gaussian'] = \
+                len(values), state[1], state[2], state[3], state[4]
+            f = open(self.path(key, 'data.states'), 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(record.tostring())
+            f.close()  # also releases the lock
+
+    def append(self, fname, values):  # writes only the values the file lacks, then its new length
+        try:
+            f = open(fname, 'r+b')
+        except IOError:  # a new file
+            self.replace(fname, lambda f: f.write(npyHeader(values.dtype, len(values)) + values.tostring()))
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)  # another process appending waits, then finds the values written
+        numpy.lib.format.read_magic(f)
+        shape, fortran, dtype = numpy.lib.format.read_array_header_1_0(f)
+        if f.tell() != HEADER or dtype != values.dtype or len(shape) != 1:  # not written here: replaced whole
+            f.close()
+            self.replace(fname, lambda f: f.write(npyHeader(values.dtype, len(values)) + values.tostring()))
+            return
+        if shape[0] < len(values):  # otherwise it already holds these values (and maybe more)
+            f.seek(HEADER + shape[0] * dtype.itemsize)
+            f.write(values[shape[0]:].tostring())
+            f.seek(0)
+            f.write(npyHeader(dtype, len(values)))  # last, so a partial append is never read
+        f.close()  # also releases the lock
+
+    def replace(self, fname, save, *args, **kw):  # writes a temporary file, then renames it over fname
+        f = tempfile.NamedTemporaryFile(dir=self.directory, suffix=os.path.splitext(fname)[1], delete=False)
+        save(f, *args, **kw)
+        f.close()
+        os.rename(f.name, fname)
+
+
+disk = DiskStore()
+
+
+def digest(*parts):  # sha1 of the canonical repr, or None
+    content = canonical(parts)
+    return None if content is None else hashlib.sha1(content).hexdigest()
+
+
+def modelDigest(model):  # the model's class and experiment
+    return digest('model', type(model).__module__, type(model).__name__, model.getExperiment())
+
+
+def dataDigest(model):  # the model and the initial state of its RNG: models with equal digests simulate equal data
+    if model.dataFingerprint is False:  # computed once per start of the data
+        modelDigest = model.fingerprint.digest
+        model.dataFingerprint = None if modelDigest is None else digest('data', modelDigest, model.simRNG.savedState)
+    return model.dataFingerprint
+
+
+class Fingerprint(object):
+    # The identity of a model in the likelihood tables: a digest of its class and experiment, with floats
+    # in canonical form.  Equal models, however and wherever they were made, hold the same Fingerprint
+    # (interned while any model holds it) and so share entries; a model whose experiment has no
+    # content-based repr (e.g. one holding a patch) has a Fingerprint of its own.
+    def __init__(self, digest):
+        self.digest = digest
+        self.models = weakref.WeakSet()
+
+    def __str__(self):
+        for model in self.models:
+            return model.str_name()
+        return str(self.digest)
+
+
+fingerprints = weakref.WeakValueDictionary()  # digest -> Fingerprint
+
+
+def fingerprint(model):
+    key = modelDigest(model)
+    F = None if key is None else fingerprints.get(key)
+    if F is None:
+        F = Fingerprint(key)
+        if key is not None:
+            fingerprints[key] = F
+    F.models.add(model)
+    return F
+
+
+class Twins(object):
+    # Live models that simulate equal data (equal dataDigest), so that one reuses the data, RNG state and
+    # likelihoods another has already computed
     def __init__(self):
-        self.table = {}
+        self.models = weakref.WeakValueDictionary()  # data digest -> the first model holding the most data
+
+    def get(self, model):  # a live twin of model, or None
+        key = dataDigest(model)
+        twin = None if key is None else self.models.get(key)
+        return None if twin is model else twin
+
+    def add(self, model):
+        key = dataDigest(model)
+        if key is None:
+            return
+        twin = self.models.get(key)
+        if twin is None or len(twin.data) < len(model.data):
+            self.models[key] = model
+
+
+twins = Twins()
+
+
+class TableOfModels(object):
+    # Entries are keyed by the models' Fingerprints, so equal models share an entry.  The keys are weak
+    # references: an entry goes when the last model holding its Fingerprint does.
+    def __init__(self, dtype=None, owner=None):
+        self.dtype = dtype
+        self.owner = (lambda: None) if owner is None else weakref.ref(owner)
+        self.table = weakref.WeakKeyDictionary()  # Fingerprint -> Column
+        self.used = weakref.WeakKeyDictionary()  # Fingerprint -> clock tick of last use
+        self.spilled = weakref.WeakKeyDictionary()  # Fingerprint -> file of an evicted entry
+        cache.tables.add(self)
 
     def getOrMakeEntry(self, model):
+        key = model.fingerprint
+        self.used[key] = next(clock)
+        cache.use(self, key, self.used[key])
         try:
-            entry = self.table[model]
+            entry = self.table[key]
         except KeyError:
-            entry = []
-            self.table[model] = entry
+            entry = self.restore(key)
+            self.table[key] = entry
+        cache.enforce(entry)  # also accounts for the entry
         return entry
 
+    def get(self, model):  # the entry of model, or None; does not count as a use
+        return self.table.get(model.fingerprint)
+
+    def restore(self, key):
+        entry = Column(self.dtype)
+        fname = self.spilled.pop(key, None)
+        if fname is not None:
+            entry.extend(numpy.load(fname))
+            removeSpill(fname)
+        return entry
+
+    def evict(self, key):
+        entry = self.table.pop(key)
+        cache.forget(id(entry))
+        directory = cache.spillDirectory()
+        if directory is not None and len(entry) > 0 and entry.dtype is not object:
+            self.spilled[key] = spillFile(directory, self, key, entry.view())
+
+    def nbytes(self):
+        return sum(entry.nbytes() for entry in self.table.values())
+
     def trim(self, mReps=0):
-        for model in self.table:
-            del self.table[model][mReps:]
+        for model in self.table.keys():
+            self.table[model].trim(mReps)
+        for model in self.spilled.keys():  # recomputed when next needed
+            removeSpill(self.spilled.pop(model))
 
 
 class DataOnly(object):
     def __init__(self, data=None):
         if data is None:
-            self.data = []
+            self.data = Column()
         else:
             self.data = data
         self.mReps = len(self.data)
@@ -1,4 +1,5 @@
 __author__ = 'sean'
+import numpy
 import scipy.stats
 import toy
 import parameter
@@ -30,15 +31,44 @@ class FlatSimple(toy.FlatToy):
         self.n = self.experiment['n']
         self.p = self.experiment['p']
         self.B = scipy.stats.binom(self.n, self.p)
+        self.logpmf = self.B.logpmf(self.support())  # likelihoods are lookups in this table
 
     def simulateOnce(self, RNG=None):
         if RNG is None:
             RNG = self.initRNG(None)
         return RNG.binomial(self.n, self.p)
 
+    def simulateBatch(self, n, RNG=None):
+        if RNG is None:
+            RNG = self.initRNG(None)
+        return RNG.binomial(self.n, self.p, size=n)
+
     def likeOnce(self, datum):
         return self.B.logpmf(datum)
 
+    def likeBatch(self, data):
+        data = numpy.asarray(data)
+        if data.dtype.kind not in 'iu':
+            return self.B.logpmf(data)  # -inf outside the support, like likeOnce
+        inside = (data >= 0) & (data <= self.n)
+        return numpy.where(inside, self.logpmf[numpy.clip(data, 0, self.n)], -numpy.infty)
+
+    def likeFamily(self, family, data):
+        data = numpy.asarray(data)
+        if data.dtype.kind not in 'iu':
+            return toy.FlatToy.likeFamily(self, family, data)
+        n, tables = family.column('n'), family.column('logpmf')
+        inside = (data >= 0) & (data <= n)
+        return numpy.where(inside, tables[numpy.arange(family.K)[:, numpy.newaxis],
+                                          numpy.clip(data, 0, tables.shape[1] - 1)], -numpy.infty)
+
+    def unpackFamily(self, family):
+        n, p = family.column('n'), family.column('p')
+        return {'logpmf': scipy.stats.binom.logpmf(numpy.arange(n.max() + 1)[numpy.newaxis, :], n, p)}  # K x (max n + 1)
+
+    def support(self):
+        return numpy.arange(self.n + 1)
+
     def datumWellFormed(self,datum):
         return isinstance(datum, int)
 
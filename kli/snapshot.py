@@ -0,0 +1,214 @@
+import json
+import struct
+import numpy
+import parameter
+import channel
+from parameter import u
+
+# A snapshot stores Parameters, Expressions, Levels, Nodes and Channels in one compact binary blob:
+#   MAGIC, then (version, header length) as little-endian unsigned ints, then a JSON header describing
+#   the structure (names, units, the expression DAG, levels, nodes and edge lists), then the parameter
+#   vectors (value, default, lower, upper) as a 4 x nParameters float64 array.
+# Objects shared between the stored models (e.g. a parameter used by several channels) stay shared.
+MAGIC = b'KLISNAP'
+VERSION = 1
+prefix = struct.Struct('<II')
+
+
+class Writer(object):
+    def __init__(self):
+        self.parameters = []  # Parameter objects, in table order
+        self.expressions = []  # Expression objects, nested expressions first
+        self.levels = []
+        self.nodes = []
+        self.index = {}  # id(object) -> index in its table
+
+    def ref(self, x):
+        # reference to a parameter, expression or constant (a number, possibly with units)
+        if isinstance(x, parameter.Parameter):
+            return {'p': self.addParameter(x)}
+        if isinstance(x, parameter.Expression):
+            return {'e': self.addExpression(x)}
+        if hasattr(x, 'units'):
+            return {'q': [float(x.magnitude), str(x.units)]}
+        return {'f': float(x)}
+
+    def add(self, table, x):
+        table.append(x)
+        self.index[id(x)] = len(table) - 1
+        return len(table) - 1
+
+    def addParameter(self, P):
+        if id(P) in self.index:
+            return self.index[id(P)]
+        if P.remapped:
+            self.ref(P.mappedValue)  # mapped parameters are stored before P
+        return self.add(self.parameters, P)
+
+    def addExpression(self, E):
+        if id(E) in self.index:
+            return self.index[id(E)]
+        for P in E.PS.pDict.itervalues():
+            self.addParameter(P)
+        for nested in E.PS.eDict.itervalues():
+            self.addExpression(nested)
+        return self.add(self.expressions, E)
+
+    def addLevel(self, L):
+        if id(L) in self.index:
+            return self.index[id(L)]
+        self.ref(L.mean)
+        self.ref(L.std)
+        return self.add(self.levels, L)
+
+    def addNode(self, n):
+        if id(n) in self.index:
+            return self.index[id(n)]
+        self.addLevel(n.level)
+        return self.add(self.nodes, n)
+
+    def model(self, x):
+        if isinstance(x, channel.Channel):
+            return {'channel': {'nodes': [self.addNode(n) for n in x.nodes],
+                                'edges': [[row, column, self.ref(q)]
+                                          for (row, column), q in sorted(x.transitions.iteritems())]}}
+        if isinstance(x, channel.Node):
+            return {'node': self.addNode(x)}
+        if isinstance(x, channel.Level):
+            return {'level': self.addLevel(x)}
+        return self.ref(x)
+
+    def header(self, models):
+        return {'parameters': [{'name': P.name, 'units': str(P.value.units), 'log': P.useLog,
+                                'map': self.ref(P.mappedValue) if P.remapped else None}
+                               for P in self.parameters],
+                'expressions': [{'name': E.name, 'expr': E.expr,
+                                 'p': sorted(self.index[id(P)] for P in E.PS.pDict.itervalues()),
+                                 'e': sorted(self.index[id(F)] for F in E.PS.eDict.itervalues())}
+                                for E in self.expressions],
+                'levels': [{'name': L.name, 'mean': self.ref(L.mean), 'std': self.ref(L.std)}
+                           for L in self.levels],
+                'nodes': [{'name': n.name, 'level': self.index[id(n.level)], 'weight': n.weight}
+                          for n in self.nodes],
+                'models': models}
+
+    def vectors(self):
+        return numpy.array([[P.Value() for P in self.parameters],
+                            [P.Default() for P in self.parameters],
+                            [P.Lower() for P in self.parameters],
+                            [P.Upper() for P in self.parameters]], dtype='<f8').reshape(4, len(self.parameters))
+
+
+def dumps(models):
+    # models: {name: Channel, Node, Level, Parameter or Expression}
+    W = Writer()
+    entries = dict((name, W.model(x)) for name, x in models.iteritems())
+    header = json.dumps(W.header(entries), separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return MAGIC + prefix.pack(VERSION, len(header)) + header + W.vectors().tostring()
+
+
+class Reader(object):
+    def __init__(self, header, vectors):
+        self.header = header
+        self.vectors = vectors
+        self.units = {}  # parsed units, shared by parameters with the same units
+        self.parameters = []
+        for i, spec in enumerate(header['parameters']):
+            self.parameters.append(self.makeParameter(i, spec))
+        self.expressions = []
+        for spec in header['expressions']:
+            self.expressions.append(self.makeExpression(spec))
+        for P, spec in zip(self.parameters, header['parameters']):
+            if spec['map'] is not None:
+                P.remap(self.deref(spec['map']))  # once every parameter and expression it may be mapped to exists
+        self.levels = [channel.Level(spec['name'], self.deref(spec['mean']), self.deref(spec['std']))
+                       for spec in header['levels']]
+        self.nodes = []
+        for spec in header['nodes']:
+            n = channel.Node(spec['name'], self.levels[spec['level']])
+            n.weight = spec['weight']
+            self.nodes.append(n)
+
+    def quantity(self, magnitude, units):
+        try:
+            unit = self.units[units]
+        except KeyError:
+            unit = u.Quantity(1., units).units
+            self.units[units] = unit
+        return u.Quantity(magnitude, unit)
+
+    def deref(self, ref):
+        if 'p' in ref:
+            return self.parameters[ref['p']]
+        if 'e' in ref:
+            return self.expressions[ref['e']]
+        if 'q' in ref:
+            return self.quantity(*ref['q'])
+        return ref['f']
+
+    def makeParameter(self, i, spec):
+        # Parameter without running its constructor: values were checked when the snapshot was written
+        P = parameter.Parameter.__new__(parameter.Parameter)
+        value, default, lower, upper = self.vectors[:, i].tolist()
+        P.name = spec['name']
+        P.useLog = spec['log']
+        P.useAD = False
+        P.value = self.quantity(value, spec['units'])
+        P.default = self.quantity(default, spec['units'])
+        P.bounds = self.quantity(numpy.matrix([lower, upper]), spec['units'])
+        P._ADvalue = None
+        P.remapped = False
+        P.mappedValue = None  # remapped by __init__ once everything is built
+        return P
+
+    def makeExpression(self, spec):
+        # Expression without evaluating it; it is evaluated (and checked) on first use
+        E = parameter.Expression.__new__(parameter.Expression)
+        E.name = spec['name']
+        E.expr = spec['expr']
+        E.PS = parameter.Space([self.parameters[i] for i in spec['p']] +
+                               [self.expressions[i] for i in spec['e']])
+        E.useAD = False
+        E.frozen = False
+        E.lastP = {}
+        E.lastE = {}
+        E.lastV = None
+        return E
+
+    def model(self, entry):
+        if 'channel' in entry:
+            ch = channel.Channel([self.nodes[i] for i in entry['channel']['nodes']])
+            ch.edges([(ch.nodes[row].name, ch.nodes[column].name, self.deref(ref))
+                      for row, column, ref in entry['channel']['edges']])
+            return ch
+        if 'node' in entry:
+            return self.nodes[entry['node']]
+        if 'level' in entry:
+            return self.levels[entry['level']]
+        return self.deref(entry)
+
+
+def loads(data):
+    assert data[:len(MAGIC)] == MAGIC  # not a snapshot
+    start = len(MAGIC) + prefix.size
+    version, length = prefix.unpack(data[len(MAGIC):start])
+    assert version <= VERSION  # written by a newer version of kli
+    header = json.loads(data[start:start + length].decode('utf-8'))
+    nParameters = len(header['parameters'])
+    vectors = numpy.frombuffer(data, dtype='<f8', count=4 * nParameters,
+                               offset=start + length).reshape(4, nParameters)
+    R = Reader(header, vectors)
+    return dict((name, R.model(entry)) for name, entry in header['models'].iteritems())
+
+
+def save(fname, models):
+    f = open(fname, 'wb')
+    f.write(dumps(models))
+    f.close()
+
+
+def load(fname):
+    f = open(fname, 'rb')
+    data = f.read()  # the whole library in a single read
+    f.close()
+    return loads(data)
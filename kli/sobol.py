@@ -0,0 +1,52 @@
+import numpy
+
+# Sobol low-discrepancy points, 32 bits per coordinate.  Direction numbers for the dimensions after the
+# first are those of Joe and Kuo ("Constructing Sobol sequences with better two-dimensional projections",
+# 2008): (degree s, coefficients a, initial m_1..m_s) of each primitive polynomial.  Point i is the XOR of
+# the direction numbers of the set bits of i, so any point can be computed directly; the first 2**k points
+# are the same set as those of the Gray-code ordering.
+BITS = 32
+JoeKuo = [(1, 0, (1,)),
+          (2, 1, (1, 3)),
+          (3, 1, (1, 3, 1)),
+          (3, 2, (1, 1, 1)),
+          (4, 1, (1, 1, 3, 3)),
+          (4, 4, (1, 3, 5, 13)),
+          (5, 2, (1, 1, 5, 5, 17)),
+          (5, 4, (1, 1, 5, 5, 5)),
+          (5, 7, (1, 1, 7, 11, 19)),
+          (5, 11, (1, 1, 5, 1, 1)),
+          (5, 13, (1, 1, 1, 3, 11)),
+          (5, 14, (1, 3, 5, 5, 31)),
+          (6, 1, (1, 3, 3, 9, 7, 49)),
+          (6, 13, (1, 1, 1, 15, 21, 21)),
+          (6, 16, (1, 3, 1, 13, 27, 49))]
+DIMENSIONS = len(JoeKuo) + 1
+
+
+def directions(dimension):
+    # the BITS direction numbers of a dimension (0-based), as integers scaled by 2**BITS
+    if dimension == 0:
+        return [1 << (BITS - 1 - k) for k in range(BITS)]
+    s, a, m = JoeKuo[dimension - 1]
+    v = [m[k] << (BITS - 1 - k) for k in range(s)]
+    for k in range(s, BITS):
+        x = v[k - s] ^ (v[k - s] >> s)
+        for j in range(1, s):
+            if (a >> (s - 1 - j)) & 1:
+                x ^= v[k - j]
+        v.append(x)
+    return v
+
+
+V = numpy.array([directions(d) for d in range(DIMENSIONS)], dtype=numpy.uint64)
+
+
+def points(indices, first, m):
+    # coordinates first, ..., first+m-1 of points indices, as BITS-bit integers in a len(indices) x m array
+    assert first + m <= DIMENSIONS  # no direction numbers beyond
+    i = numpy.asarray(indices, dtype=numpy.uint64)[:, numpy.newaxis]
+    x = numpy.zeros((len(i), m), dtype=numpy.uint64)
+    for b in range(BITS):
+        x ^= ((i >> numpy.uint64(b)) & numpy.uint64(1)) * V[first:first + m, b][numpy.newaxis, :]
+    return x
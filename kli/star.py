@@ -5,13 +5,13 @@ import toy
 
 class Star(object):
     def __init__(self, hyp, alt, trueModel=None, mReps=None, seed=None):
-        self.RNG = toy.SaveStateRNG(seed)
         self.hyp = hyp
         self.alt = alt
         if trueModel is None:
             self.trueModel = hyp
         else:
             self.trueModel = trueModel
+        self.RNG = toy.SaveStateRNG(self.trueModel.selectorSeed(seed))  # common seed under common random numbers
         assert self.trueModel.rReps == 1
         assert mReps is not None
         self.mReps = mReps
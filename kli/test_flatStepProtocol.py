@@ -69,7 +69,7 @@ class TestFlatStepProtocol(TestCase):
         self.FS.sim(10)
 
     def test_patch_like(self):
-        self.assertEquals(kli.patch.FS.like(), -112.83060748764734)  # -168.873183577661)
+        self.assertEquals(kli.patch.demo().FS.like(), -112.83060748764734)  # -168.873183577661)
 
     # The following test passed when patch was setting VOLTAGE
     # according to channel.VOLTAGE not self.VOLTAGE
@@ -80,7 +80,7 @@ class TestFlatStepProtocol(TestCase):
         # This test used to fail because patch was setting VOLTAGE
         # according to channel.VOLTAGE not self.VOLTAGE
         self.assertEquals(self.FS.mReps, 10)
-        self.assertEqual(kli.patch.FS.like(), self.FS.like())
+        self.assertEqual(kli.patch.demo().FS.like(), self.FS.like())
 
     # def test_old_patch_like(self):
     #     self.assertEquals(kli.patch.FS.like(),-26.748642946985434)
@@ -102,3 +102,123 @@ class TestFlatStepProtocol(TestCase):
         self.assertEquals(Q[1, 1], -0.27975526187055599)
         self.assertEquals(Q[2, 2], -0.31716333921770673)
         self.assertEquals(Q[1, 0], 0.21230321647287806)
+
+    def test_kernel_matches_expressions(self):
+        self.VOLTAGE.remap(-20*u.mV)
+        Q = self.khh.getKernel().Q()
+        self.assertAlmostEqual(Q[0, 1], self.a1.evaluate().to('1/ms').magnitude)
+        self.assertAlmostEqual(Q[2, 1], self.b2.evaluate().to('1/ms').magnitude)
+        self.assertAlmostEqual(Q[1, 1], -(self.b1 + self.a2).to('1/ms').magnitude)
+
+    def test_kernel_follows_units(self):
+        self.VOLTAGE.remap(-20*u.mV)
+        before = self.khh.getKernel().Q()
+        self.ta1.setUnits('s')  # same magnitude, 1000 times longer: the rates through tau1 are 1000 times slower
+        self.assertAlmostEqual(self.khh.getKernel().Q()[0, 1], self.a1.evaluate().to('1/ms').magnitude)
+        self.assertAlmostEqual(self.khh.getKernel().Q()[0, 1], before[0, 1]/1000.)
+
+    def test_kernel_per_stimulus(self):
+        K = self.khh.getKernel(self.VOLTAGE)
+        other = kli.parameter.Parameter("VOLTAGE", -65., "mV", log=False)  # same name, a different parameter
+        self.assertIsNot(self.khh.getKernel(other), K)
+        self.assertIsNone(self.khh.getKernel(other).stimulus)  # not a parameter of the channel
+        kli.parameter.Parameter("unrelated", 1., "ms").setUnits('s')  # other models' units leave K alone
+        self.assertIs(self.khh.getKernel(self.VOLTAGE), K)
+
+    def test_assign_vector_refreshes_likelihood(self):
+        before = self.FS.like()
+        PS = self.khh.PS
+        x = PS.pack(names=['ta1'])
+        PS.assignVector(x + np.log(2.), names=['ta1'])  # tau1 twice as long
+        self.FS.sim(10)  # the data of the old values are dropped
+        after = self.FS.like()
+        self.assertNotEqual(after, before)
+        fresh = self.SP.flatten(5)  # made with the new values
+        fresh.sim(10)
+        self.assertEqual(after, fresh.like())
+
+    def test_kernel_time_units(self):
+        Qms = self.khhPatch.makeQM(-20., 'mV', 'ms')
+        Qs = self.khhPatch.makeQM(-0.02, 'V', 's')
+        np.testing.assert_allclose(Qs, 1000.*Qms)
+
+    def test_stacked_q(self):
+        volts = np.linspace(-100., 40., 8)
+        Qs = self.khh.makeQs(self.VOLTAGE, volts)
+        self.assertEquals(Qs.shape, (8, 3, 3))
+        for v, Q in zip(volts, Qs):
+            np.testing.assert_allclose(Q, self.khhPatch.makeQM(v, 'mV', 'ms'), rtol=1e-14)
+
+    def test_batched_edges(self):
+        ch = kli.channel.Channel([kli.channel.Node("C1", self.Closed), kli.channel.Node("C2", self.Closed)])
+        ch.addNodes([kli.channel.Node("O", self.Open)])
+        ch.biEdges([("C1", "C2", self.a1, self.b1), ("C2", "O", self.a2, self.b2)])
+        self.assertEquals(sorted(ch.PS.pDict), sorted(self.khh.PS.pDict))
+        self.assertEquals(sorted(ch.PS.eDict), sorted(self.khh.PS.eDict))
+        np.testing.assert_array_equal(ch.makeQ()._magnitude, self.khh.makeQ()._magnitude)
+        ch.biEdge("C2", "O", self.a1, self.b1)  # replacing rates rebuilds the parameter space
+        self.assertEquals(sorted(ch.PS.eDict), ['K1', 'tau1', 'vr'])
+
+    def test_failed_edges_leave_channel(self):
+        Q = self.khh.makeQ()._magnitude
+        names = sorted(self.khh.PS.pDict)
+        impostor = kli.parameter.Parameter("ta1", 1., "1/ms")  # clashes with the ta1 already in the channel
+        with self.assertRaises(AssertionError):
+            self.khh.edges([("C1", "O", impostor)])
+        with self.assertRaises(KeyError):
+            self.khh.edges([("O", "C1", self.a1), ("O", "C3", self.b1)])
+        with self.assertRaises(AssertionError):
+            self.khh.addNodes([kli.channel.Node("C3", self.Closed), kli.channel.Node("O", self.Open)])
+        self.assertEquals(len(self.khh.nodes), 3)
+        self.assertEquals(sorted(self.khh.PS.pDict), names)
+        np.testing.assert_array_equal(self.khh.makeQ()._magnitude, Q)
+
+    def test_edits_check_integrity(self):
+        self.khh.nodes[0].name = "O"  # two nodes now share a name; the next edit runs integrity() and finds it
+        self.assertRaises(AssertionError, self.khh.edge, "C2", "O", self.a2)
+
+    def test_pure_evaluation_in_threads(self):
+        from multiprocessing.pool import ThreadPool
+        names = self.khhPatch.kernel().names
+        p = self.khhPatch.kernel().values()
+        volts = np.linspace(-100., 40., 16)
+        serial = self.khhPatch.pureA(p, volts, 0.01)
+        pool = ThreadPool(4)
+        threaded = pool.map(lambda v: self.khhPatch.pureA(p, v, 0.01), volts)
+        pool.close()
+        np.testing.assert_array_equal(np.array(threaded), serial)
+        self.assertEquals(self.VOLTAGE.mappedValue, self.V0)  # shared VOLTAGE never remapped
+        doubled = self.khhPatch.pureQ({'ta1': 8.8, 'ta2': 5.2}, -20.)
+        np.testing.assert_allclose(doubled, 0.5*self.khhPatch.pureQ(p, -20.))
+        self.assertEquals(len(names), len(p))
+
+    def test_pure_q_leaves_parameters(self):
+        shift = kli.parameter.Expression("shift", "V1 + V2", [self.V1, self.V2])
+        self.OFFSET.remap(shift)  # now completing a dict would evaluate an Expression
+        Q = self.khhPatch.pureQ({}, -20.)
+        marker = object()
+        shift.lastV = marker
+        self.vr.lastV = marker
+        before = (self.OFFSET.value, self.VOLTAGE.mappedValue, self.V1.value)
+        np.testing.assert_array_equal(self.khhPatch.pureQ({'ta1': 4.4}, -20.), Q)
+        self.assertIs(shift.lastV, marker)
+        self.assertIs(self.vr.lastV, marker)
+        self.assertEquals((self.OFFSET.value, self.VOLTAGE.mappedValue, self.V1.value), before)
+
+    def test_jacobian_q(self):
+        volts = np.array([-80., -20., 10.])
+        Q, dQ, names = self.khhPatch.jacobianQ(volts, 'mV', 'ms')
+        self.assertEquals(dQ.shape, (3, 3, 3, len(self.khh.PS.pDict)))
+        np.testing.assert_allclose(Q, self.khhPatch.makeQMs(volts, 'mV', 'ms'))
+        K = self.khhPatch.kernel('mV', 'ms')
+        p = K.values()
+        for k, name in enumerate(K.names):
+            h = 1e-6*max(abs(p[k]), 1.)
+            up, down = p.copy(), p.copy()
+            up[k] += h
+            down[k] -= h
+            finite = (K.Qs(up, volts) - K.Qs(down, volts))/(2*h)
+            if name == 'VOLTAGE':  # stimulus: derivative with respect to volts
+                finite = (K.Qs(p, volts + h) - K.Qs(p, volts - h))/(2*h)
+            np.testing.assert_allclose(dQ[..., names.index(name)], finite, rtol=1e-5, atol=1e-9)
+        self.assertFalse(dQ[..., names.index('g_open')].any())
@@ -1,5 +1,6 @@
 from unittest import TestCase
 import kli.tick
+import kli.toy
 
 __author__ = 'sean'
 
@@ -21,3 +22,8 @@ class Test_Ticking(TestCase):
 
   def test_TickTG_RootFindSig(self):
     self.assertEquals(self.FTG.sig_norm, 0.54896596462491032)
+
+  def test_TickTG_DegenerateFails(self):
+    self.FTG.mu_norm = -100.  # draws are essentially never positive: fail rather than hang
+    self.assertRaises(AssertionError, self.FTG.simulateBatch, 10, kli.toy.SaveStateRNG(3))
+    self.assertRaises(AssertionError, self.FTG.simulateBatch, 10, kli.toy.CounterRNG(3, n=10))
@@ -0,0 +1,88 @@
+from unittest import TestCase
+import unittest
+import numpy as np
+import kli.philox
+import kli.sobol
+import kli.toy
+import kli.tick
+import kli.simple
+import kli.repetitions
+
+
+class TestCounterRNG(TestCase):
+    def test_philox_known_answers(self):  # from the Random123 distribution
+        self.assertEqual([int(x) for x in kli.philox.philox4x32(0, 0, 0, 0, 0, 0)],
+                         [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8])
+        self.assertEqual([int(x) for x in kli.philox.philox4x32(0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344,
+                                                                0xa4093822, 0x299f31d0)],
+                         [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1])
+
+    def test_replicates_in_any_order(self):
+        for parent in [kli.toy.Toy([2., 3.]), kli.tick.TruncatedGaussian(cv=.5)]:
+            serial = parent.flatten(seed=kli.toy.CounterRNG(11))
+            serial.extend_data(500)
+            other = parent.flatten(seed=kli.toy.CounterRNG(11))
+            parts = [other.simulateReplicates(start, start + 100) for start in (400, 0, 300, 100, 200)]
+            self.assertEqual(np.concatenate([parts[1], parts[3], parts[4], parts[2], parts[0]]).tolist(),
+                             serial.get_data(500).tolist())
+            one = other.simulateEach(5, other.simRNG.replicates(250, 5))
+            self.assertEqual(one, serial.get_data(500)[250:255].tolist())
+
+    def test_resim(self):
+        FT = kli.toy.Toy([2.]).flatten(seed=kli.toy.CounterRNG(3))
+        FT.sim(50)
+        first = FT.get_data(50).tolist()
+        FT.resim(50)
+        self.assertEqual(FT.get_data(50).tolist(), first)
+
+
+class TestCommonRandomNumbers(TestCase):
+    def test_coupled_data_and_selections(self):
+        crn = kli.toy.CommonRandomNumbers(4)
+        low = kli.simple.Simple(n=20, p=.4).flatten(seed=crn)
+        high = kli.simple.Simple(n=20, p=.45).flatten(seed=crn)
+        self.assertTrue(np.all(high.get_data(1000) >= low.get_data(1000)))  # inversion couples the data
+        low.bootstrap(50, 1000)
+        high.bootstrap(50, 1000)
+        self.assertEqual(low.selection.choice.tolist(), high.selection.choice.tolist())
+        R = kli.repetitions.Repetitions(low, 3)
+        S = kli.repetitions.Repetitions(high, 3)
+        R.bootstrap(10, 300)
+        S.bootstrap(10, 300)
+        self.assertEqual(R.selection.choice.tolist(), S.selection.choice.tolist())
+
+    def test_tick_variance_reduction(self):  # spread over seeds of the difference of two nearby models' means
+        for parent, other in [(kli.tick.TruncatedGaussian(cv=.5), kli.tick.TruncatedGaussian(cv=.55)),
+                              (kli.tick.InverseGaussian(cv=.5), kli.tick.InverseGaussian(cv=.55))]:
+            coupled, independent = [], []
+            for r in range(8):
+                crn = kli.toy.CommonRandomNumbers(r)
+                coupled.append(np.mean(parent.flatten(seed=crn).get_data(500) -
+                                       other.flatten(seed=crn).get_data(500)))
+                independent.append(np.mean(parent.flatten(seed=kli.toy.CounterRNG(2*r)).get_data(500) -
+                                           other.flatten(seed=kli.toy.CounterRNG(2*r+1)).get_data(500)))
+            self.assertLess(np.var(coupled), np.var(independent)/10.)
+
+
+class TestQuasiMonteCarlo(TestCase):
+    def test_sobol_stratified(self):  # each coordinate of the first 2**k points has one point per 1/2**k
+        x = kli.sobol.points(np.arange(1024), 0, kli.sobol.DIMENSIONS) >> np.uint64(22)
+        for d in range(kli.sobol.DIMENSIONS):
+            self.assertEqual(sorted(x[:, d].tolist()), range(1024))
+
+    def test_antithetic_pairs(self):
+        u = kli.toy.AntitheticRNG(5, 0, 6).random_sample(6)
+        self.assertTrue(np.allclose(u[0::2] + u[1::2], 1.))
+
+    def test_randomized_error(self):
+        H = kli.toy.Toy([2.]).flatten()
+        A = kli.toy.Toy([2.5]).flatten()
+        exact = np.log(2./2.5) + 2.5/2. - 1.
+        KL, se = H.randomizedQMC(A, mReps=1024, randomizations=8, seed=1)
+        self.assertLess(abs(KL - exact), 4*se)
+        mcKL, mcSE = H.randomizedQMC(A, mReps=1024, randomizations=8, seed=1, RNG=kli.toy.CounterRNG)
+        self.assertLess(se, mcSE/4.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+from unittest import TestCase
+import unittest
+import numpy as np
+import kli.parameter
+
+
+class TestPackedSpace(TestCase):
+    def setUp(self):
+        self.ta1 = kli.parameter.Parameter("ta1", 4.4, "ms", log=True)
+        self.tk1 = kli.parameter.Parameter("tk1", -0.025, "1/mV", log=False)
+        self.VOLTAGE = kli.parameter.Parameter("VOLTAGE", -65., "mV", log=False)
+        self.VOLTAGE.remap(-20.*kli.parameter.u.mV)
+        self.tau1 = kli.parameter.Expression("tau1", "ta1*exp(tk1*VOLTAGE)", [self.ta1, self.tk1, self.VOLTAGE])
+        self.PS = kli.parameter.Space([self.tau1])
+
+    def test_names(self):
+        self.assertEqual(self.PS.names(), ['ta1', 'tk1'])
+        self.assertEqual(self.PS.names(free=False), ['VOLTAGE', 'ta1', 'tk1'])
+
+    def test_pack(self):
+        np.testing.assert_allclose(self.PS.pack(), [np.log(4.4), -0.025])
+        np.testing.assert_allclose(self.PS.pack(useLog=False), [4.4, -0.025])
+        lower, upper = self.PS.packBounds()
+        self.assertEqual(lower.tolist(), [-np.inf, -np.inf])
+        self.assertEqual(upper.tolist(), [np.inf, np.inf])
+
+    def test_assign_vector(self):
+        before = self.PS.version()
+        self.PS.assignVector([np.log(2.), 0.5])
+        self.assertAlmostEqual(self.ta1.Value(), 2.)
+        self.assertEqual(self.tk1.Value(), 0.5)
+        self.assertGreater(self.PS.version(), before)
+        self.assertAlmostEqual(self.tau1.evaluate().magnitude, 2.*np.exp(-10.))
+
+    def test_assign_vector_out_of_bounds(self):
+        self.tk1.setUpper(0.)
+        before = self.PS.version()
+        self.assertRaises(AssertionError, self.PS.assignVector, [1., 0.5])
+        self.assertEqual(self.ta1.Value(), 4.4)  # nothing assigned
+        self.assertEqual(self.PS.version(), before)
+
+if __name__ == '__main__':
+    unittest.main()
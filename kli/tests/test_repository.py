@@ -0,0 +1,234 @@
+from unittest import TestCase
+import unittest
+import gc
+import os
+import shutil
+import tempfile
+import numpy as np
+import kli.repository
+import kli.toy
+import kli.tick
+import kli.simple
+
+
+class TestColumn(TestCase):
+    def test_growth_and_views(self):
+        C = kli.repository.Column(capacity=2)
+        C.extend([1, 2, 3])
+        self.assertEqual(C.dtype, np.int64)
+        C.append(0.5)
+        self.assertEqual(C.dtype, np.float64)
+        self.assertEqual(C[0:4].tolist(), [1., 2., 3., .5])
+        self.assertTrue(np.may_share_memory(C[0:2], C.buffer))
+        C.trim(1)
+        self.assertEqual(len(C), 1)
+        C.append([1, 2])
+        self.assertEqual(C[1], [1, 2])
+
+    def test_flat_toy(self):
+        FT = kli.toy.Toy([2.]).flatten(seed=3)
+        FT.sim(100)
+        self.assertEqual(len(FT.get_likes()), 100)
+        self.assertTrue(np.may_share_memory(FT.get_data(), FT.data.buffer))
+        FT.trim(10)
+        self.assertEqual(len(FT.likes.getOrMakeEntry(FT)), 10)
+
+    def test_batch_matches_each(self):
+        for parent in [kli.toy.Toy([2., 3.]), kli.tick.TruncatedGaussian(cv=.5)]:
+            A = parent.flatten(seed=5)
+            B = parent.flatten(seed=5)
+            self.assertEqual(A.simulateBatch(50, A.simRNG).tolist(), B.simulateEach(50, B.simRNG))
+            self.assertEqual(A.simRNG.random_sample(), B.simRNG.random_sample())
+
+    def test_like_batch_matches_each(self):
+        for parent in [kli.toy.Toy([2., 3.]), kli.simple.Simple(10, .3), kli.tick.InverseGaussian(cv=.5)]:
+            FT = parent.flatten(seed=5)
+            data = FT.get_data(50).copy()
+            data[0] = -1
+            self.assertEqual(FT.likeBatch(data).tolist(), FT.likeEach(data))
+
+
+class TestLikelihoodCache(TestCase):
+    def tearDown(self):
+        kli.repository.cache.configure()
+
+    def test_budget_and_spill(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        H = kli.toy.Toy([2.5]).flatten()
+        A = kli.toy.Toy([3.]).flatten()
+        expected = H.get_likes(T, 1000).copy()
+        kli.repository.cache.configure(budget=12000, spill=True)
+        A.get_likes(T, 1000)  # H, least recently used, is spilled
+        self.assertFalse(H.fingerprint in T.likes.table)
+        self.assertTrue(H.fingerprint in T.likes.spilled)
+        self.assertEqual(H.get_likes(T, 1000).tolist(), expected.tolist())
+        self.assertFalse(A.fingerprint in T.likes.table)
+        usage = [row for row in kli.repository.cache.usage() if row[0] is T]
+        self.assertEqual(sorted(row[2] for row in usage if row[1] is not None), [0, 8192])
+
+    def test_spill_files_go_with_models(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        H = kli.toy.Toy([2.5]).flatten()
+        H.get_likes(T, 1000)
+        kli.repository.cache.configure(budget=12000, spill=True)
+        kli.toy.Toy([3.]).flatten().get_likes(T, 1000)  # H is spilled
+        fname = T.likes.spilled[H.fingerprint]
+        self.assertTrue(os.path.exists(fname))
+        del H
+        gc.collect()
+        self.assertFalse(os.path.exists(fname))
+        self.assertEqual(kli.repository.cache.total, kli.repository.cache.nbytes())
+
+    def test_uses_kept_only_with_a_budget(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        H = kli.toy.Toy([2.5]).flatten()
+        for n in range(1, 200):
+            H.get_likes(T, n)
+        self.assertEqual(kli.repository.cache.uses, [])
+        kli.repository.cache.configure(budget=10 ** 6)
+        self.assertEqual(len(kli.repository.cache.uses), 1)  # rebuilt from the tables' last uses
+        for n in range(200, 400):
+            H.get_likes(T, n)
+        self.assertLessEqual(len(kli.repository.cache.uses), kli.repository.cache.limit)
+
+    def test_dead_models_are_dropped(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        kli.toy.Toy([2.5]).flatten().get_likes(T, 100)
+        gc.collect()  # a FlatToy refers to itself (base), so it goes with the cycle collector
+        self.assertEqual(len(T.likes.table), 0)
+
+
+class TestFingerprints(TestCase):
+    def test_equal_models_share_work(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        H = kli.toy.Toy([2.5]).flatten()
+        expected = H.get_likes(T, 100).copy()
+        again = kli.toy.Toy([2.5]).flatten()  # equal to H, made separately
+        self.assertIs(again.fingerprint, H.fingerprint)
+        self.assertIsNot(kli.toy.Toy([2.5000001]).flatten().fingerprint, H.fingerprint)
+        self.assertIs(T.likes.get(again), T.likes.get(H))
+        twin = kli.toy.Toy([2.]).flatten(seed=1)  # simulates the same data as T
+        self.assertEqual(again.get_likes(twin, 100).tolist(), expected.tolist())
+        self.assertEqual(twin.get_data(300).tolist(), T.get_data(300).tolist())
+        self.assertEqual(kli.toy.Toy([2.]).flatten(seed=1).get_data(300).tolist(), T.get_data(300).tolist())
+
+    def test_twins_reuse_only_what_is_asked(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1)
+        H = kli.toy.Toy([2.5]).flatten()
+        H.get_likes(T, 1000)
+        B = kli.toy.Toy([2.]).flatten(seed=1)  # a twin of T, which holds 1000 replicates
+        B.sim(10)
+        self.assertEqual(len(B.data), 10)
+        self.assertEqual(len(H.get_likes(B, None)), 10)
+        self.assertEqual(B.get_data(300).tolist(), T.get_data(300).tolist())  # simulated on from 10
+
+    def test_canonical_numbers(self):
+        self.assertEqual(kli.repository.canonical((2L, -0., np.float64(.1))), kli.repository.canonical((2, 0., .1)))
+
+
+class TestWeights(TestCase):
+    def test_weighted_statistics(self):
+        H = kli.toy.Toy([2.]).flatten(seed=1)
+        A = kli.toy.Toy([2.5]).flatten()
+        H.sim(1000)
+        H.weightedBootstrap(1000, 1000, 7)
+        ratios = H.get_likes(H, 1000) - A.get_likes(H, 1000)
+        selected = np.repeat(ratios, H.selection.counts[0])  # the bootstrap the counts stand for
+        self.assertAlmostEqual(H.PFalsify(A), np.mean(selected > 0))
+        mu, sig = H.likeRatioMuSigma(A)
+        self.assertAlmostEqual(mu, np.mean(selected))
+        self.assertAlmostEqual(sig, np.std(selected))
+        self.assertAlmostEqual(H.KL(A), np.mean(selected))
+        H.weightedBootstrap(1000, 1000, 7, nBoot=5, poisson=True)
+        self.assertEqual(H.PFalsify(A).shape, (5,))
+
+    def test_matches_materialized_bootstrap(self):
+        H = kli.toy.Toy([2.]).flatten(seed=1)
+        A = kli.toy.Toy([2.5]).flatten()
+        H.sim(1000)
+        weights = kli.toy.Weights(H, 1000, 1000, 7)
+        selected = kli.toy.Select(H, None, 1000)  # the bootstrap the counts stand for, drawn one by one
+        selected.choice = np.repeat(np.arange(1000), weights.counts[0])[:, np.newaxis]
+        for statistic in [lambda S: H.PFalsify(A, selection=S), lambda S: H.KL(A, selection=S),
+                          lambda S: H.likeRatioMuSigma(A, selection=S), lambda S: H.Ehlogf(selection=S),
+                          lambda S: A.minuslike(H, S)]:
+            np.testing.assert_allclose(statistic(weights), statistic(selected), rtol=1e-12)
+        for perDatum in [lambda: A.likelihoods(H, weights), lambda: H.aic(A, selection=weights),
+                         lambda: H.get_bootstrap_data(weights)]:
+            self.assertRaises(ValueError, perDatum)
+
+    def test_empty_poisson_bootstrap(self):
+        H = kli.toy.Toy([2.]).flatten(seed=1)
+        A = kli.toy.Toy([2.5]).flatten()
+        H.sim(1000)
+        H.weightedBootstrap(1, 1000, 7, nBoot=50, poisson=True)  # most bootstraps draw nothing
+        empty = H.selection.total() == 0
+        self.assertTrue(empty.any() and not empty.all())
+        with np.errstate(all='raise'):
+            mu, sig = H.likeRatioMuSigma(A)
+            P = H.PFalsify(A)
+        for x in [mu, sig, P]:
+            self.assertEqual(np.isnan(x).tolist(), empty.tolist())
+
+
+class TestRatioStream(TestCase):
+    def test_matches_statistics(self):
+        H = kli.toy.Toy([2.]).flatten(seed=1)
+        A = kli.toy.Toy([2.5]).flatten()
+        H.sim(1000)
+        H.bootstrap(2000, 1000, 3)
+        stream = H.likeRatioStream(A, block=300)
+        self.assertEqual(stream.n, 2000)
+        self.assertEqual(stream.PFalsify(), H.PFalsify(A))
+        self.assertAlmostEqual(stream.KL(), H.KL(A))
+        mu, sig = H.likeRatioMuSigma(A)
+        self.assertAlmostEqual(stream.muSigma()[1], sig)
+        self.assertAlmostEqual(stream.CV(), H.likeRatioCV(A))
+
+
+class TestDiskStore(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.parent = kli.toy.Toy([2., 3.])
+
+    def tearDown(self):
+        kli.repository.disk.configure()
+        shutil.rmtree(self.directory)
+
+    def test_data_and_likes_persist(self):
+        plain = self.parent.flatten(seed=4)
+        H = kli.toy.Toy([2.5]).flatten()
+        expected = H.get_likes(plain, 300).copy()
+        kli.repository.disk.configure(self.directory)
+        first = self.parent.flatten(seed=4)
+        H.get_likes(first, 200)
+        second = self.parent.flatten(seed=4)  # a later session
+        self.assertEqual(second.get_data(200).tolist(), plain.get_data(200).tolist())
+        self.assertEqual(H.get_likes(second, 300).tolist(), expected.tolist())  # continues past what was stored
+
+    def test_stored_data_only_up_to_what_is_asked(self):
+        plain = self.parent.flatten(seed=4).get_data(1000).copy()
+        gc.collect()  # no live twins: models use the store
+        kli.repository.disk.configure(self.directory)
+        first = self.parent.flatten(seed=4)
+        for n in [10, 100, 1000]:  # grows the stored file by appending
+            first.get_data(n)
+        del first
+        fname = os.path.join(self.directory, os.listdir(self.directory)[0].split('.')[0] + '.data.npy')
+        self.assertEqual(len(np.load(fname)), 1000)
+        for n in [10, 50, 1000]:
+            gc.collect()
+            later = self.parent.flatten(seed=4)
+            later.sim(n)
+            self.assertEqual(len(later.data), n)
+            self.assertEqual(later.get_data(300).tolist(), plain[:300].tolist())  # the RNG follows on from n
+
+    def test_other_seeds_are_not_shared(self):
+        kli.repository.disk.configure(self.directory)
+        a = self.parent.flatten(seed=4).get_data(10)
+        b = self.parent.flatten(seed=5).get_data(10)
+        self.assertNotEqual(a.tolist(), b.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
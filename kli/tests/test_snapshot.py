@@ -0,0 +1,54 @@
+from unittest import TestCase
+import unittest
+import numpy as np
+import kli.channel
+import kli.parameter
+import kli.patch
+import kli.snapshot
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.canonical = kli.channel.canonical()
+        self.data = kli.snapshot.dumps({'khh': self.canonical.khh, 'tau1': self.canonical.tau1,
+                                        'Open': self.canonical.Open})
+        self.models = kli.snapshot.loads(self.data)
+
+    def test_round_trip_q(self):
+        khh = self.models['khh']
+        VOLTAGE = khh.PS.pDict['VOLTAGE']
+        for volts in [-80., -20., 30.]:
+            Q = kli.patch.singleChannelPatch(khh, VOLTAGE).makeQM(volts, 'mV', 'ms')
+            Q0 = kli.patch.singleChannelPatch(self.canonical.khh, self.canonical.VOLTAGE).makeQM(volts, 'mV', 'ms')
+            np.testing.assert_array_equal(Q, Q0)
+
+    def test_round_trip_parameters(self):
+        khh = self.models['khh']
+        self.assertEqual(sorted(khh.PS.pDict), sorted(self.canonical.khh.PS.pDict))
+        ta1 = khh.PS.pDict['ta1']
+        self.assertEqual(ta1.Value(), 4.4)
+        self.assertTrue(ta1.useLog)
+        self.assertEqual(str(ta1.value.units), str(self.canonical.ta1.value.units))
+        self.assertEqual(khh.PS.pDict['VOLTAGE'].mappedValue.name, 'V0')
+        self.assertEqual(self.models['tau1'].evaluate(), self.canonical.tau1.evaluate())
+
+    def test_shared_objects(self):
+        khh = self.models['khh']
+        self.assertTrue(self.models['tau1'] is khh.PS.eDict['tau1'])
+        self.assertTrue(self.models['Open'] is khh.nodes[2].level)
+
+    def test_expression_remap(self):
+        VOLTAGE = kli.parameter.Parameter("VOLTAGE", -65., "mV")
+        V1 = kli.parameter.Parameter("V1", 20., "mV")
+        half = kli.parameter.Expression("half", "V1/2", [V1])
+        VOLTAGE.remap(half)
+        models = kli.snapshot.loads(kli.snapshot.dumps({'VOLTAGE': VOLTAGE}))
+        self.assertEqual(models['VOLTAGE'].mappedValue.name, 'half')
+        self.assertEqual(models['VOLTAGE'].mappedValue.evaluate(), half.evaluate())
+
+    def test_version(self):
+        newer = kli.snapshot.MAGIC + kli.snapshot.prefix.pack(kli.snapshot.VERSION + 1, 0)
+        self.assertRaises(AssertionError, kli.snapshot.loads, newer)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from unittest import TestCase
+import unittest
+import numpy as np
+import scipy.stats
+import kli.toy
+import kli.repetitions
+import kli.simple
+import kli.tick
+
+
+class TestImportanceSampling(TestCase):
+    def setUp(self):
+        self.H = kli.toy.Toy([2.]).flatten(seed=1)
+        self.A = kli.toy.Toy([2.5]).flatten(seed=2)
+
+    def exact(self, r):  # the ratio is positive when the sum of r Exp(2) data exceeds -r*log(.8)/.5
+        return 1. - scipy.stats.gamma.cdf(-r*np.log(.8)/.5, r, scale=.5)
+
+    def test_tail(self):
+        P, se = self.H.PFalsifyImportance(self.A, rReps=800, mReps=800*2000, seed=3, stderr=True)
+        self.assertLess(abs(P - self.exact(800)), 4*se)
+        self.assertLess(se, 5e-5)  # relative error of the miss probability (~8e-4) below 10%
+
+    def test_defaults(self):
+        self.H.sim(1000)
+        P = self.H.PFalsifyImportance(self.A)  # as many proposal replicates as H holds
+        self.assertLess(abs(P - self.exact(1)), .05)
+        self.assertRaises(ValueError, kli.toy.Toy([2.]).flatten(seed=4).PFalsifyImportance, self.A)
+
+    def test_repetitions(self):
+        R = kli.repetitions.Repetitions(self.H, 100)
+        P, se = R.PFalsifyImportance(kli.repetitions.Repetitions(self.A, 100), mReps=100*2000, seed=3,
+                                     stderr=True)
+        self.assertLess(abs(P - self.exact(100)), 4*se)
+
+
+class TestSequential(TestCase):
+    def test_stops_at_precision(self):
+        H = kli.toy.Toy([2.]).flatten(seed=1)
+        A = kli.toy.Toy([2.5]).flatten()
+        P, (lower, upper), n = H.sequential(A, 'PFalsify', .01, block=1000)
+        self.assertLessEqual((upper - lower)/2., .01)
+        self.assertTrue(lower <= P <= upper)
+        self.assertEqual(n % 1000, 0)
+        KL, (lower, upper), n = H.sequential(A, 'KL', .001, block=1000)
+        exact = np.log(2./2.5) + 2.5/2. - 1.  # KL of exponentials
+        self.assertTrue(lower - .001 < exact < upper + .001)
+
+    def test_easy_points_stop_early(self):
+        H = kli.repetitions.Repetitions(kli.toy.Toy([2.]).flatten(seed=1), 200)
+        A = kli.repetitions.Repetitions(kli.toy.Toy([4.]).flatten(), 200)
+        P, interval, n = H.sequential(A, 'PFalsify', .01, block=500)
+        self.assertEqual((P, n), (1., 500))
+
+
+class TestRepetitionLikelihoods(TestCase):
+    def test_slices_and_views_match_sums(self):
+        H = kli.repetitions.Repetitions(kli.toy.Toy([2.]).flatten(seed=1), 3)
+        A = kli.repetitions.Repetitions(kli.toy.Toy([2.5]).flatten(), 3)
+        H.bootstrap(40, 300, 5)
+        base = H.base.get_data(300)
+        expected = [sum(A.base.likeOnce(datum) for datum in base[row]) for row in H.selection.choice]
+        likes = A.likelihoods(H)
+        np.testing.assert_allclose(likes, expected, rtol=1e-12)
+        sliced = [A.likelihoods(H, rows=slice(first, first + 7)) for first in range(0, 40, 7)]
+        self.assertEqual(np.concatenate(sliced).tolist(), likes.tolist())
+        data = H.get_data(300)
+        self.assertEqual(data.tolist(), [base[3*i:3*i + 3].tolist() for i in range(100)])
+        self.assertTrue(np.may_share_memory(data, H.base.data.view()))  # a view, not a copy
+
+
+class TestControlVariates(TestCase):
+    def setUp(self):
+        self.H = kli.toy.Toy([2.]).flatten(seed=1)
+        self.A = kli.toy.Toy([2.5]).flatten()
+        self.H.sim(2000)
+        self.exactKL = kli.toy.Toy([2.]).exact().KL(kli.toy.Toy([2.5]).exact())
+
+    def test_exact(self):
+        self.assertAlmostEqual(self.exactKL, np.log(2./2.5) + 2.5/2. - 1.)
+        PFalsify = kli.toy.Toy([2.]).exact(800).PFalsify(kli.toy.Toy([2.5]).exact(800))
+        self.assertAlmostEqual(PFalsify, TestImportanceSampling('test_tail').exact(800))
+
+    def test_control_of_itself_is_exact(self):
+        self.assertAlmostEqual(self.H.controlled(self.A, [(self.H, self.A, self.exactKL)]), self.exactKL)
+
+    def test_richer_model(self):
+        R = kli.toy.Toy([2., 100.]).flatten()  # an exponential with a short delay, no closed forms
+        KL, se = R.controlled(self.A, [(self.H, self.A, self.exactKL)], 'KL', self.H, stderr=True)
+        self.assertLess(se, .75*R.likeRatioMuSigma(self.A, self.H)[1]/np.sqrt(2000))
+
+
+class TestCounts(TestCase):
+    def test_counts_match_replicates(self):
+        S = kli.simple.Simple(n=20, p=.5).flatten(seed=1)
+        A = kli.simple.Simple(n=20, p=.45).flatten()
+        for bReps, seed in [(None, None), (3000, 5)]:
+            S.bootstrap(bReps, 2000, seed)
+            expected = [S.KL(A), S.PFalsify(A), S.like()] + list(S.likeRatioMuSigma(A))
+            S.countedBootstrap(bReps, 2000, seed)
+            self.assertEqual(S.selection.total(), len(S.selection.choice))
+            actual = [S.KL(A), S.PFalsify(A), S.like()] + list(S.likeRatioMuSigma(A))
+            self.assertTrue(np.allclose(actual, expected, rtol=1e-12))
+        self.assertEqual(S.valueCounts(500).tolist(), np.bincount(S.get_data(500), minlength=21).tolist())
+
+
+class TestFamily(TestCase):
+    def test_members_match_spawned_models(self):
+        cases = [(kli.toy.Toy([2., 3.]).flatten(seed=1), dict(q0=[1., 2., 3.], q1=[3., 3., 4.])),
+                 (kli.simple.Simple(n=20, p=.5).flatten(seed=1), dict(n=[18, 20, 21], p=[.4, .5, .6]))]
+        for T, kw in cases:
+            T.sim(1000)
+            F = kli.toy.Family(T, block=1000, **kw)  # one member per block
+            spawned = [T.spawn(**dict((name, values[k]) for name, values in kw.items())) for k in range(3)]
+            self.assertEqual(F.likes(T).tolist(), [M.likeBatch(T.get_data()).tolist() for M in spawned])
+            self.assertTrue(np.allclose(F.KL(T), [T.KL(M) for M in spawned], rtol=1e-12))
+            self.assertEqual(F.PFalsify(T).tolist(), [T.PFalsify(M) for M in spawned])
+
+    def test_tick_columns_match_spawned_models(self):
+        for T in [kli.tick.TruncatedGaussian(cv=.5).flatten(seed=1), kli.tick.InverseGaussian(cv=.5).flatten(seed=1)]:
+            T.sim(1000)
+            cvs = [.1, .3, .5, .7, .9]
+            F = kli.toy.Family(T, block=2000, cv=cvs)  # two members per block
+            spawned = [T.spawn(cv=cv) for cv in cvs]
+            np.testing.assert_allclose(F.likes(T), [M.likeBatch(T.get_data()) for M in spawned], rtol=1e-6)
+            np.testing.assert_allclose(F.KL(T), [T.KL(M) for M in spawned], rtol=1e-6, atol=1e-9)
+
+    def test_members_have_names(self):
+        T = kli.toy.Toy([2.]).flatten(seed=1, name='T')
+        F = kli.toy.Family(T, q=[2., 3.])
+        M = F.member(0)
+        self.assertIs(M.fingerprint, T.fingerprint)  # equal to T, so the same key in the tables
+        self.assertEqual(M.str_name(), 'T with q=2.0')
+        str(M.fingerprint)
+        self.assertEqual(F.part(1, 2).member(0).experiment['q'], 3.)
+
+
+if __name__ == '__main__':
+    unittest.main()
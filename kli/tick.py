@@ -63,6 +63,32 @@ def TruncNormMomentsErrorSciPy(mu_sig_notrunc, mu_desired, sig_desired):
     TruncNorm = scipy.stats.truncnorm(a, b, loc=mu_notrunc, scale=sig_notrunc)
     return (TruncNorm.mean() - mu_desired, TruncNorm.var() - sig_desired**2)
 
+def TruncNormMomentsInverse(mu_desired, sig_desired, iterations=100):
+    # (mu_n, sig_n) of the untruncated normals solving TruncNormMomentsError, elementwise for arrays:
+    # Newton's method from (mu_desired, sig_desired), steps shortened to keep sig_n positive
+    mu_desired, sig_desired = numpy.broadcast_arrays(numpy.asarray(mu_desired, dtype=float),
+                                                     numpy.asarray(sig_desired, dtype=float))
+    mu_n, sig_n = mu_desired.copy(), sig_desired.copy()
+    for i in range(iterations):
+        alpha = TruncNormAlpha(mu_n, sig_n)
+        lam = numpy.exp(scipy.stats.norm.logpdf(alpha) - scipy.stats.norm.logsf(alpha))
+        dlam = lam*(lam - alpha)  # d lambda / d alpha
+        g = 1. + alpha*lam - lam**2  # variance over sig_n**2
+        dg = lam + alpha*dlam - 2.*lam*dlam
+        e1, e2 = mu_n + sig_n*lam - mu_desired, sig_n**2*g - sig_desired**2
+        J11, J12, J21, J22 = 1. - dlam, lam - alpha*dlam, -sig_n*dg, sig_n*(2.*g - alpha*dg)
+        det = J11*J22 - J12*J21
+        dm, ds = (J22*e1 - J12*e2)/det, (J11*e2 - J21*e1)/det
+        t = numpy.ones_like(dm)
+        while numpy.any(sig_n - t*ds <= 0.):
+            t[sig_n - t*ds <= 0.] /= 2.
+        mu_n, sig_n = mu_n - t*dm, sig_n - t*ds
+        step = numpy.maximum(abs(t*dm), abs(t*ds))/sig_n
+        if numpy.all(step <= 1e-10):
+            break
+    assert numpy.all(step <= 1e-8)  # as close as scipy.optimize.root comes (a cv of 1 or more has no solution)
+    return mu_n, sig_n
+
 class FlatTruncatedGaussian(toy.FlatToy):
     def unpackExperiment(self):
         self.cv = self.experiment['cv']
@@ -88,12 +114,59 @@ class FlatTruncatedGaussian(toy.FlatToy):
             # not too inefficient because for most parameter values we care about, x will usually be positive
         return x
 
+    def simulateBatch(self, n, RNG=None):
+        if RNG is None:
+            RNG = self.initRNG(None)
+        if isinstance(RNG, toy.InversionRNG):
+            return self.TruncNorm.ppf(RNG.random_sample(n))
+        if isinstance(RNG, toy.CounterRNG):  # every replicate redraws until its own draw is non-negative
+            data = RNG.normal(self.mu_norm, self.sig_norm, size=n)
+            redraw = data < 0.
+            i = 0
+            while redraw.any():
+                assert i < 100  # as in simulateOnce, fails rather than hangs if draws are almost never positive
+                i += 1
+                x = RNG.normal(self.mu_norm, self.sig_norm, size=n)
+                data[redraw] = x[redraw]
+                redraw = data < 0.
+            return data
+        # keeps the non-negative draws; drawing only as many as are still missing consumes the same
+        # normals as n calls of simulateOnce, so the data and the RNG state match
+        data = numpy.empty(n)
+        k = 0
+        i = 0
+        while k < n:
+            assert i < 100  # as in simulateOnce
+            i += 1
+            x = RNG.normal(self.mu_norm, self.sig_norm, size=n-k)
+            x = x[x >= 0.]
+            data[k:k+len(x)] = x
+            k += len(x)
+        return data
+
     def likeOnce(self, datum):
         if datum < 0:
             return -numpy.infty
         else:
             return self.Norm.logpdf(datum) - numpy.log(1.-self.Norm.cdf(0))
 
+    def likeBatch(self, data):
+        data = numpy.asarray(data, dtype=float)
+        return numpy.where(data < 0, -numpy.infty, self.Norm.logpdf(data) - numpy.log(1.-self.Norm.cdf(0)))
+
+    def likeFamily(self, family, data):
+        data = numpy.asarray(data, dtype=float)[numpy.newaxis, :]
+        mu_norm, sig_norm = family.column('mu_norm'), family.column('sig_norm')
+        L = (-.5*((data - mu_norm)/sig_norm)**2 - numpy.log(sig_norm) - .5*numpy.log(2.*numpy.pi)
+             - family.column('logsf0'))
+        return numpy.where(data < 0, -numpy.infty, L)
+
+    def unpackFamily(self, family):
+        mu, cv = family.column('mu'), family.column('cv')
+        mu_norm, sig_norm = TruncNormMomentsInverse(mu, cv*mu)
+        return {'mu_norm': mu_norm, 'sig_norm': sig_norm,
+                'logsf0': scipy.stats.norm.logsf(0., loc=mu_norm, scale=sig_norm)}  # log(1.-Norm.cdf(0))
+
     def datumWellFormed(self, datum):
         return isinstance(numpy.pi, float)
 
@@ -119,6 +192,11 @@ class FlatInverseGaussian(toy.FlatToy):
             RNG = self.initRNG(None)
         return RNG.wald(self.mu, self.shape)
 
+    def simulateBatch(self, n, RNG=None):
+        if RNG is None:
+            RNG = self.initRNG(None)
+        return RNG.wald(self.mu, self.shape, size=n)
+
     def likeOnce(self, datum):
         # Using Wikipedia Formula because the function in Scipy Version 0.13.3 gives erroneous results!
         if datum < 0:
@@ -127,6 +205,24 @@ class FlatInverseGaussian(toy.FlatToy):
             return .5*(numpy.log(self.shape) - numpy.log(2.*numpy.pi) - 3.*numpy.log(datum)) \
                     + (-self.shape*(datum - self.mu)**2/(2.*(self.mu**2)*datum))
 
+    def likeBatch(self, data):
+        datum = numpy.asarray(data, dtype=float)
+        with numpy.errstate(all='ignore'):  # negative data are -inf below
+            L = .5*(numpy.log(self.shape) - numpy.log(2.*numpy.pi) - 3.*numpy.log(datum)) \
+                + (-self.shape*(datum - self.mu)**2/(2.*(self.mu**2)*datum))
+        return numpy.where(datum < 0, -numpy.infty, L)
+
+    def likeFamily(self, family, data):
+        datum = numpy.asarray(data, dtype=float)[numpy.newaxis, :]
+        shape, mu = family.column('shape'), family.column('mu')
+        with numpy.errstate(all='ignore'):  # negative data are -inf below
+            L = .5*(numpy.log(shape) - numpy.log(2.*numpy.pi) - 3.*numpy.log(datum)) \
+                + (-shape*(datum - mu)**2/(2.*(mu**2)*datum))
+        return numpy.where(datum < 0, -numpy.infty, L)
+
+    def unpackFamily(self, family):
+        return {'shape': family.column('mu')/(family.column('cv')**2)}
+
     def datumWellFormed(self, datum):
         return isinstance(numpy.pi, float)
 
@@ -1,10 +1,19 @@
+import os
+import bisect
+import binascii
 import numpy
 import copy
-import matplotlib.pylab as plt
-import matplotlib
+import scipy.stats
+import scipy.special
 import repository
 import parameter
-import scipy.stats
+import philox
+import sobol
+
+
+def pyplot():  # matplotlib is imported when something is first plotted, not with the module
+    import matplotlib.pylab
+    return matplotlib.pylab
 
 
 class SaveStateRNG(numpy.random.RandomState):
@@ -29,7 +38,154 @@ class SaveStateRNG(numpy.random.RandomState):
         self.set_state(self.savedState)
 
 
+class CounterRNG(object):
+    # Counter-based random numbers (Philox4x32-10): draw d of replicate i is a pure function of (seed, i, d),
+    # so replicates can be simulated in any order, or in parallel, and match a serial run bit for bit.
+    # An instance covers n replicates from start; each method returns one variate per replicate (size=n,
+    # or (n, ...)), and the drawn counter moves on by the draws each replicate used.  Variates are made from
+    # uniforms by inversion, Box-Muller or Michael-Schucany-Haas, so they differ from RandomState's.
+    name = 'Philox4x32-10'
+
+    def __init__(self, seed=None, start=0, n=1):
+        self.reseed(seed)
+        self.start = start
+        self.n = n
+        self.drawn = 0
+
+    def reseed(self, seed=None):
+        if seed is False:
+            return
+        if seed is None:
+            seed = int(binascii.hexlify(os.urandom(8)), 16)
+        self.key = int(seed) % 2**64
+        self.savedState = (self.name, numpy.array([self.key & 0xFFFFFFFF, self.key >> 32], dtype=numpy.uint32),
+                           0, 0, 0.)  # laid out like RandomState.get_state()
+
+    def restate(self, seed_or_state):
+        if isinstance(seed_or_state, tuple):
+            self.set_state(seed_or_state)
+        else:
+            self.reseed(seed_or_state)
+
+    def get_state(self):
+        return (self.name, self.savedState[1], self.start, self.drawn, 0.)
+
+    def set_state(self, state):
+        assert state[0] == self.name
+        self.reseed(int(state[1][0]) + (int(state[1][1]) << 32))
+        self.start = int(state[2])
+        self.drawn = int(state[3])
+
+    def reset(self):
+        self.drawn = 0
+
+    def replicates(self, start, n):  # a new CounterRNG, with the same seed, for replicates start..start+n-1
+        return type(self)(self.key, start, n)
+
+    def uniforms(self, size, per=1):  # per uniforms for each variate, each shaped as size
+        if size is None:
+            assert self.n == 1  # a single variate needs a single replicate
+            shape = ()
+        else:
+            shape = (size,) if isinstance(size, (int, long)) else tuple(size)
+            assert shape[0] == self.n
+        m = int(numpy.prod(shape[1:]))
+        u = self.draws(m * per)
+        self.drawn += m * per
+        u = u.reshape(self.n, m, per)
+        return [u[:, :, k].reshape(shape) for k in range(per)]
+
+    def draws(self, m):  # the next m uniforms of each replicate, n x m
+        return philox.uniforms(self.key, numpy.arange(self.start, self.start + self.n), self.drawn, m)
+
+    def random_sample(self, size=None):
+        u, = self.uniforms(size)
+        return u[()]
+
+    def standard_exponential(self, size=None):
+        u, = self.uniforms(size)
+        return -numpy.log1p(-u)[()]
+
+    def exponential(self, scale=1., size=None):
+        return scale * self.standard_exponential(size)
+
+    def standard_normal(self, size=None):
+        u1, u2 = self.uniforms(size, 2)
+        return (numpy.sqrt(-2. * numpy.log(u1)) * numpy.cos(2. * numpy.pi * u2))[()]
+
+    def normal(self, loc=0., scale=1., size=None):
+        return loc + scale * self.standard_normal(size)
+
+    def binomial(self, n, p, size=None):
+        u, = self.uniforms(size)
+        return scipy.stats.binom.ppf(u, n, p).astype(numpy.int64)[()]
+
+    def wald(self, mean, scale, size=None):
+        u1, u2, u3 = self.uniforms(size, 3)
+        y = (numpy.sqrt(-2. * numpy.log(u1)) * numpy.cos(2. * numpy.pi * u2))**2
+        x = mean + mean**2 * y / (2. * scale) - mean / (2. * scale) * numpy.sqrt(4. * mean * scale * y + (mean * y)**2)
+        return numpy.where(u3 <= mean / (mean + x), x, mean**2 / x)[()]
+
+
+class InversionRNG(CounterRNG):
+    # Variates are increasing functions of a single uniform (the inverse cdf), so that the structure of the
+    # uniforms -- low-discrepancy points, antithetic pairs -- carries over to the data.  Wald variates (the
+    # inverse cdf has no closed form and scipy's is slow) are Michael-Schucany-Haas from the chi-square of
+    # an inverted |normal| and a second uniform choosing the root.  Subclasses supply the uniforms (draws).
+    name = 'Inversion'  # its data differ from a CounterRNG's with the same seed, so it is not their twin
+    def standard_normal(self, size=None):
+        u, = self.uniforms(size)
+        return scipy.special.ndtri(u)[()]
+
+    def wald(self, mean, scale, size=None):
+        u1, u2 = self.uniforms(size, 2)
+        y = scipy.special.ndtri(.5 + .5 * u1)**2
+        x = mean + mean**2 * y / (2. * scale) - mean / (2. * scale) * numpy.sqrt(4. * mean * scale * y + (mean * y)**2)
+        return numpy.where(u2 <= mean / (mean + x), x, mean**2 / x)[()]
+
+
+class SobolRNG(InversionRNG):
+    # Randomized quasi-Monte Carlo: replicate i is point i of the Sobol sequence, its draws the successive
+    # coordinates (at most sobol.DIMENSIONS per replicate), under a random digital shift drawn from the seed.
+    # Each shift gives unbiased estimates; their spread over seeds is the error (FlatToy.randomizedQMC).
+    # The first 2**k replicates are the best balanced.
+    name = 'Sobol'
+
+    def draws(self, m):
+        shift = numpy.floor(philox.uniforms(self.key, [0], self.drawn, m) * 2.**sobol.BITS).astype(numpy.uint64)
+        x = sobol.points(numpy.arange(self.start, self.start + self.n), self.drawn, m) ^ shift
+        return (x.astype(float) + .5) / 2.**sobol.BITS
+
+
+class AntitheticRNG(InversionRNG):
+    # Antithetic pairs: replicates 2k and 2k+1 invert the uniforms u and 1-u of the counters of replicate k
+    name = 'Antithetic'
+
+    def draws(self, m):
+        replicates = numpy.arange(self.start, self.start + self.n)
+        u = philox.uniforms(self.key, replicates // 2, self.drawn, m)
+        return numpy.where((replicates % 2 == 1)[:, numpy.newaxis], 1. - u, u)
+
+
+class CommonRandomNumbers(object):
+    # Couples the random numbers of the models being compared.  Models flattened with seed=crn draw
+    # replicate i from the same counters (an InversionRNG with one seed, so normals, binomials, exponentials
+    # and truncated Gaussians are inverse cdfs of the same uniforms and the data of nearby models move
+    # together; wald variates only up to the second uniform choosing the root), and their bootstraps,
+    # Repetitions and Stars select the same indices.  Differences of KL or PFalsify between such models
+    # have much lower variance.
+    def __init__(self, seed=None):
+        self.counter = InversionRNG(seed)
+
+    def simRNG(self):
+        return self.counter.replicates(0, 1)
+
+    def selector(self):  # seed of the selection RNGs
+        return self.counter.key % 2**32
+
+
 class Select(object):
+    # choice is an int64 array of indices into the base data, one row of rReps indices per selected datum
     def __init__(self, parent, bReps=True, mReps=True, seed_or_state=None, RNG=None):
         self.bReps, self.mReps = self.process_reps(parent, bReps, mReps)
         self.rReps = parent.rReps
@@ -37,16 +193,13 @@ class Select(object):
             self.seed_or_state = None
             self.RNG = None
             len_data = int(self.mReps/self.rReps)
-            concatenated = range(len_data*self.rReps)
-            self.choice = concatenated if self.rReps == 1 else [
-                            concatenated[m*self.rReps:(m+1)*self.rReps] for m in range(len_data)]
+            self.choice = numpy.arange(len_data*self.rReps, dtype=numpy.int64).reshape(len_data, self.rReps)
         else:
             self.seed_or_state = seed_or_state
             self.RNG = SaveStateRNG() if RNG is None else RNG
             self.RNG.restate(seed_or_state)
-            concatenated = self.RNG.choice(range(self.mReps), self.bReps*self.rReps).tolist()
-            self.choice = concatenated if self.rReps == 1 else [
-                            concatenated[m*self.rReps:(m+1)*self.rReps] for m in range(self.bReps)]
+            concatenated = self.RNG.choice(self.mReps, self.bReps*self.rReps)  # same draws as choice(range(mReps))
+            self.choice = concatenated.astype(numpy.int64).reshape(self.bReps, self.rReps)
 
     def process_reps(self, parent, bReps, mReps):
         if bReps is True:
@@ -58,6 +211,230 @@ class Select(object):
         return bReps, mReps
 
 
+class Weights(Select):
+    # Count-weighted bootstrap: counts[k, m] is the number of times base replicate m is drawn in the kth of
+    # nBoot independent bootstraps, multinomial with bReps draws in total or, with poisson, independent
+    # Poisson counts of mean bReps/mReps (no fixed total).  Statistics are weighted reductions over the
+    # mReps base likelihoods, so memory does not grow with bReps.  Only for models without repetitions.
+    # There is no choice of data: what needs the selected data one by one (likelihoods, logf, likeRatios,
+    # aic, get_bootstrap_data) raises ValueError.  A Poisson bootstrap may draw nothing; its statistics are nan.
+    def __init__(self, parent, bReps=True, mReps=True, seed_or_state=None, RNG=None, nBoot=1, poisson=False):
+        self.bReps, self.mReps = self.process_reps(parent, bReps, mReps)
+        self.rReps = parent.rReps
+        assert self.rReps == 1  # a weight per base likelihood cannot select sums of repetitions
+        assert self.bReps is not None
+        self.nBoot = nBoot
+        self.poisson = poisson
+        self.seed_or_state = seed_or_state
+        self.RNG = SaveStateRNG() if RNG is None else RNG
+        self.RNG.restate(seed_or_state)
+        if poisson:
+            self.counts = self.RNG.poisson(self.bReps/float(self.mReps), size=(nBoot, self.mReps))
+        else:
+            self.counts = self.RNG.multinomial(self.bReps, [1./self.mReps]*self.mReps, size=nBoot)
+
+    @property
+    def choice(self):
+        raise ValueError("a count-weighted bootstrap selects no data one by one; use like, KL, PFalsify, "
+                         "likeRatioMuSigma or likeRatioStream, or bootstrap() for the selected data")
+
+    def total(self):
+        return self.counts.sum(axis=1)
+
+    def sum(self, x):  # one weighted sum of x (a value per base replicate) per bootstrap
+        return self.counts.dot(numpy.asarray(x)[0:self.mReps])
+
+    def divide(self, x, total):  # x/total, nan (without a warning) where a bootstrap drew nothing
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(total > 0, x/numpy.maximum(total, 1).astype(float), numpy.nan)
+
+    def mean(self, x):
+        return self.divide(self.sum(x), self.total())
+
+    def std(self, x):
+        x = numpy.asarray(x)[0:self.mReps]
+        mu = self.mean(x)
+        with numpy.errstate(invalid='ignore'):  # nan - inf where a bootstrap drew nothing
+            squares = numpy.sum(self.counts*(x - mu[:, numpy.newaxis])**2, axis=1)
+        return numpy.sqrt(self.divide(squares, self.total()))
+
+    def result(self, x):  # a number for a single bootstrap, an array for several
+        return x[0] if self.nBoot == 1 else x
+
+
+class Family(object):
+    # K members of one flattened model that differ in some experiment fields, given as arrays of K values
+    # (e.g. Family(FT, q=qs) or Family(FS, n=ns, p=ps)).  The likelihoods of a shared dataset under all the
+    # members are one broadcast likeFamily, a K x mReps array, instead of K spawned models each with its own
+    # likes; KL and PFalsify of a model against every member are reductions along the rows.  The family
+    # holds columns, not models: the fields as K x 1 arrays and what the model derives from them
+    # (unpackFamily, computed once for all the members).
+    def __init__(self, model, block=2**22, **arrays):
+        self.model = model.base
+        self.rReps = model.rReps
+        self.names = sorted(arrays)
+        assert set(self.names) <= set(self.model.experiment)  # can't add fields that aren't already there
+        values = numpy.broadcast_arrays(*[numpy.asarray(arrays[name]).ravel() for name in self.names])
+        self.K = len(values[0])
+        self.columns = dict((name, v[:, numpy.newaxis]) for name, v in zip(self.names, values))
+        self.columns.update(self.model.unpackFamily(self))
+        self.block = block  # at most this many likelihoods at a time
+
+    def part(self, first, stop):  # the family of members first..stop-1
+        F = copy.copy(self)
+        F.columns = dict((name, c[first:stop]) for name, c in self.columns.iteritems())
+        F.K = min(stop, self.K) - first
+        return F
+
+    def column(self, name):  # a field or derived column of every member, K rows
+        try:
+            return self.columns[name]
+        except KeyError:  # a field the members share
+            return numpy.array([self.model.experiment[name]] * self.K)[:, numpy.newaxis]
+
+    def member(self, k):  # member k as a model, for likelihoods only (see FlatToy.member)
+        return self.model.member(**dict((name, self.columns[name][k, 0].item()) for name in self.names))
+
+    def likes(self, trueModel, mReps=True):  # K x mReps, the likelihoods of trueModel's base data
+        return self.model.likeFamily(self, trueModel.base.get_data(mReps))
+
+    def ratios(self, hyp, trueModel=None, mReps=True):
+        # log-likelihood ratios of hyp to each member, per experiment of rReps data, a block of members at a
+        # time, and how many experiments each column stands for: discrete data without repetitions are
+        # grouped by value (as in Counts), so each distinct datum is evaluated once per member
+        if trueModel is None:
+            trueModel = hyp
+        n = trueModel.base.process_mReps(mReps) // self.rReps
+        data = trueModel.base.get_data(n*self.rReps)
+        hypLikes = hyp.base.get_likes(trueModel.base, n*self.rReps)
+        counts = None
+        if self.rReps == 1 and numpy.asarray(data).dtype.kind in 'iu':
+            data, first, counts = numpy.unique(data, return_index=True, return_counts=True)
+            hypLikes = hypLikes[first]
+        rows = max(1, self.block // max(1, len(data)))
+        for first in range(0, self.K, rows):
+            members = self.part(first, first + rows)
+            with numpy.errstate(invalid='ignore'):  # -inf - (-inf): data neither model can produce
+                ratios = hypLikes[numpy.newaxis, :] - self.model.likeFamily(members, data)
+            if counts is None:
+                yield first, ratios.reshape(members.K, n, self.rReps).sum(axis=2), numpy.ones(n, dtype=numpy.int64)
+            else:
+                yield first, ratios, counts
+
+    def KL(self, hyp, trueModel=None, mReps=True):  # hyp.KL(member, trueModel) of each member
+        KL = numpy.empty(self.K)
+        for first, ratios, counts in self.ratios(hyp, trueModel, mReps):
+            KL[first:first + len(ratios)] = ratios.dot(counts)/float(counts.sum())
+        return KL
+
+    def PFalsify(self, hyp, trueModel=None, mReps=True):  # hyp.PFalsify(member, trueModel) of each member
+        P = numpy.empty(self.K)
+        for first, ratios, counts in self.ratios(hyp, trueModel, mReps):
+            P[first:first + len(ratios)] = (ratios > 0).dot(counts)/float(counts.sum())
+        return P
+
+
+class Counts(Select):
+    # Sufficient statistic of a discrete model: counts[k] is the number of selected data equal to support[k].
+    # Statistics are dot products of the counts with each model's log-pmf over the support (supportLikes),
+    # O(support) rather than O(mReps) per model.  Only for models without repetitions.
+    def __init__(self, parent, bReps=True, mReps=True, seed_or_state=None, RNG=None):
+        Select.__init__(self, parent, bReps, mReps, seed_or_state, RNG)
+        assert self.rReps == 1  # counts of single data cannot select sums of repetitions
+        self.support = parent.support()
+        assert self.support is not None  # data with no discrete support
+        self.counts = None
+
+    def count(self, parent):  # once the selected data exist
+        if self.bReps is None:
+            self.counts = parent.valueCounts(self.mReps)
+        else:
+            index = parent.supportIndex(parent.get_data(self.mReps)[self.choice.ravel()])
+            self.counts = numpy.bincount(index, minlength=len(self.support))
+
+    def total(self):
+        return self.counts.sum()
+
+    def sum(self, x):  # sum of x (a value per support point) over the selected data
+        seen = self.counts > 0  # values never seen add nothing, even where x is -inf
+        return self.counts[seen].dot(numpy.asarray(x)[seen])
+
+    def mean(self, x):
+        return self.sum(x)/float(self.total())
+
+    def std(self, x):
+        mu = self.mean(x)
+        seen = self.counts > 0
+        return numpy.sqrt(self.counts[seen].dot((numpy.asarray(x)[seen] - mu)**2)/float(self.total()))
+
+
+class RatioStream(object):
+    # One-pass statistics of likelihood ratios, fed block by block: the count, the number of positive
+    # ratios and Welford's running mean and sum of squared deviations (blocks merged as in Chan et al.),
+    # so PFalsify, KL and the moments can be read at any time without keeping the ratios
+    def __init__(self):
+        self.n = 0
+        self.positives = 0
+        self.mean = 0.
+        self.M2 = 0.
+
+    def add(self, ratios, counts=None):  # counts: how many times each ratio was drawn (count-weighted bootstrap)
+        ratios = numpy.asarray(ratios, dtype=float).ravel()
+        if counts is None:
+            k = len(ratios)
+            if k == 0:
+                return
+            mean = ratios.mean()
+            M2 = numpy.sum((ratios - mean)**2)
+            positives = numpy.count_nonzero(ratios > 0)
+        else:
+            counts = numpy.asarray(counts).ravel()
+            k = int(counts.sum())
+            if k == 0:
+                return
+            mean = counts.dot(ratios)/float(k)
+            M2 = counts.dot((ratios - mean)**2)
+            positives = int(counts[ratios > 0].sum())
+        n = self.n + k
+        delta = mean - self.mean
+        self.mean += delta*k/float(n)
+        self.M2 += M2 + delta**2*self.n*k/float(n)
+        self.n = n
+        self.positives += positives
+
+    def PFalsify(self, adjustExtreme=False):
+        if self.n == 0:
+            print "Warning: No Likelihoods"
+            return None
+        number_of_positives = self.positives
+        if adjustExtreme and number_of_positives == 0:
+            number_of_positives += 0.5
+        elif adjustExtreme and number_of_positives == self.n:
+            number_of_positives -= 0.5
+        return number_of_positives/float(self.n)
+
+    def KL(self):
+        return self.mean
+
+    def muSigma(self):  # sigma as numpy.std, without the n-1 correction
+        return self.mean, numpy.sqrt(self.M2/self.n)
+
+    def CV(self):
+        mu, sig = self.muSigma()
+        return sig/mu
+
+    def PFalsifyInterval(self, C=0.95):  # Clopper-Pearson (exact binomial) interval
+        alpha = 1. - C
+        x = self.positives
+        lower = 0. if x == 0 else scipy.stats.beta.ppf(alpha/2., x, self.n - x + 1)
+        upper = 1. if x == self.n else scipy.stats.beta.ppf(1. - alpha/2., x + 1, self.n - x)
+        return lower, upper
+
+    def meanInterval(self, C=0.95):  # central limit interval for the mean (KL when the true model is hyp)
+        halfWidth = scipy.stats.norm.ppf(.5 + C/2.)*numpy.sqrt(self.M2/self.n)/numpy.sqrt(self.n)
+        return self.mean - halfWidth, self.mean + halfWidth
+
+
 class Toy(object):
     def __init__(self, qs):
         self.qs = qs
@@ -69,6 +446,10 @@ class Toy(object):
         FT = FlatToy(parent, seed, name)
         return FT
 
+    def exact(self, r=1):
+        parent = self  # for readability
+        return ExactToy(parent, r)
+
     def getExperiment(self):  # For subclassing replace this code
         assert len(self.qs) == 1 or len(self.qs) == 2  # have not implemented other toy models
         if len(self.qs) == 1:
@@ -84,9 +465,40 @@ class Toy(object):
         return {'toy2':toy2, 'q':q, 'q0':q0, 'q1':q1}
 
 
+class ExactToy(object):
+    # Closed forms for the exponential toy (toy2) and experiments of r repetitions, whose summed data are
+    # Gamma(r, 1/q); exact references for the control variates of FlatToy.controlled
+    def __init__(self, parent, r=1):
+        self.experiment = parent.getExperiment()
+        assert self.experiment['toy2']  # no closed forms for toy 3
+        self.q = self.experiment['q']
+        self.r = r
+
+    def Elogf(self, trueModel=None):
+        if trueModel is None:
+            trueModel = self
+        return self.r * (numpy.log(self.q) - self.q / trueModel.q)
+
+    def KL(self, other, true_model=None):
+        if true_model is None:
+            true_model = self
+        return self.Elogf(true_model) - other.Elogf(true_model)
+
+    def PFalsify(self, other, true_model=None):
+        if true_model is None:
+            true_model = self
+        if self.q == other.q:
+            return 0.
+        # the ratio r*log(q/q_other) - (q - q_other)*sum is positive on one side of the boundary b
+        b = self.r * numpy.log(self.q / other.q) / (self.q - other.q)
+        S = scipy.stats.gamma(self.r, scale=1. / true_model.q)
+        return S.cdf(b) if self.q > other.q else S.sf(b)
+
+
 class FlatToy(object):
     def __init__(self, parent, seed=None, name=None, kw=None):
         self.debugFlag = False  # To save hidden states, call self.debug() before generating data
+        self.crn = seed if isinstance(seed, CommonRandomNumbers) else None
         self.simRNG = self.initRNG(seed)
         self.selection = None
         self.setUpExperiment(parent, kw)
@@ -99,7 +511,7 @@ class FlatToy(object):
         return self.experiment
 
     def setUpExperiment(self, parent, kw):
-        self.experiment = parent.getExperiment()
+        self.experiment = copy.copy(parent.getExperiment())  # spawn must not change the parent
         if kw is not None:
             original_experiment_length = len(self.experiment)
             self.experiment.update(kw)
@@ -116,6 +528,20 @@ class FlatToy(object):
         parent = self  # for readability
         return type(self)(parent, seed, name, kw)
 
+    def member(self, **kw):  # the model with experiment fields kw changed, for likelihoods only: no data, no RNG
+        M = type(self).__new__(type(self))
+        M.experiment = copy.copy(self.experiment)
+        assert set(kw) <= set(M.experiment)  # can't add fields that aren't already there
+        M.experiment.update(kw)
+        M.unpackExperiment()
+        M.supportTables = {}
+        M.fingerprint = repository.fingerprint(M)
+        M.rename(self.str_name() + ' with ' + ', '.join('%s=%r' % item for item in sorted(kw.items())))
+        return M
+
+    def unpackFamily(self, family):  # Overload along with likeFamily: {name: K-row column} derived from the fields
+        return {}
+
     def rename(self, name=None):
         if name is None:
             name = repr(self)
@@ -156,25 +582,57 @@ class FlatToy(object):
     def mTotal(self):  # overloaded for Repetitions class
         return len(self.data)
 
+    def selectorSeed(self, selector_seed_or_state=None):  # common selections for models sharing random numbers
+        if selector_seed_or_state is None and self.base.crn is not None:
+            return self.base.crn.selector()
+        return selector_seed_or_state
+
     def bootstrap(self, bReps=True, mReps=True, selector_seed_or_state=None):
-        self.selection = Select(self, bReps, mReps, selector_seed_or_state)
+        self.refresh()  # before the selection, which a refresh would drop
+        self.selection = Select(self, bReps, mReps, self.selectorSeed(selector_seed_or_state))
+        self.extend_data(self.selection)
+        self.bReps = self.selection.bReps
+        self.mReps = self.selection.mReps
+
+    def weightedBootstrap(self, bReps=True, mReps=True, selector_seed_or_state=None, nBoot=1, poisson=False):
+        self.refresh()  # before the selection, which a refresh would drop
+        self.selection = Weights(self, bReps, mReps, self.selectorSeed(selector_seed_or_state),
+                                 nBoot=nBoot, poisson=poisson)
         self.extend_data(self.selection)
         self.bReps = self.selection.bReps
         self.mReps = self.selection.mReps
 
+    def countedBootstrap(self, bReps=True, mReps=True, selector_seed_or_state=None):  # discrete models only
+        self.refresh()  # before the selection, which a refresh would drop
+        self.selection = Counts(self, bReps, mReps, self.selectorSeed(selector_seed_or_state))
+        self.extend_data(self.selection)
+        self.selection.count(self)
+        self.bReps = self.selection.bReps
+        self.mReps = self.selection.mReps
+
     def initRNG(self, seed=None):  # Maybe overloaded if using a different RNG, eg rpy2
+        if isinstance(seed, CounterRNG):  # seed=toy.CounterRNG(seed) for counter-based random numbers
+            return seed.replicates(0, 1)
+        if isinstance(seed, CommonRandomNumbers):
+            return seed.simRNG()
         return SaveStateRNG(seed)
 
     def startData(self):
-        self.data = []  # Data used for fitting model. (Each datum may be a tuple)
+        self.data = repository.Column()  # Data used for fitting model. (Each datum may be a tuple)
         self.hiddenStates = []  # These are the Markov states, including hidden ones.  This model isn't Markovian, though
         self.bReps = None
         self.mReps = 0
         self.selection = None
+        self.counted = None  # value counts of the first countedReps data, for discrete models
+        self.countedReps = 0
+        self.dataFingerprint = False  # not yet computed, see repository.dataDigest
+        self.dataStates = []  # (n, RNG state after n replicates), by n; twins reuse data only up to a known state
 
     def startLikes(self):
-        self.likes = repository.TableOfModels()
-        self.likeInfo = repository.TableOfModels()
+        self.fingerprint = repository.fingerprint(self)  # the key of this model's likelihoods in tables
+        self.likes = repository.TableOfModels(numpy.float64, self)
+        self.likeInfo = repository.TableOfModels(None, self)
+        self.supportTables = {}
 
     def _restart(self):  # Clears data and resets RNG with same seed
         self.simRNG.reset()
@@ -191,12 +649,62 @@ class FlatToy(object):
         self._restart()
 
     def extend_data(self, mReps=True):  # New reps added, keeps old; if (mReps <= len(self.data) then does nothing
+        self.refresh()
         mReps = self.process_mReps(mReps)
         numNewReps = mReps - len(self.data)  # Nothing changed if negative
-        for n in range(numNewReps):
-            self.data.append(self.simulateOnce(self.simRNG))  # Don't want to use self.R elsewhere
-            if self.debugFlag:
-                self.hiddenStates.append(self.hiddenStateTrajectory)
+        if numNewReps <= 0:
+            return
+        self.data.reserve(mReps)
+        counter = isinstance(self.simRNG, CounterRNG)
+        if not self.debugFlag:
+            # Data of a live model with equal data, then stored data, are reused, but never past mReps and only
+            # up to a length whose RNG state is known; a CounterRNG has no state to restore
+            twin = repository.twins.get(self)
+            if twin is not None:
+                n, state = twin.dataState(mReps)
+                if n > len(self.data):
+                    self.data.extend(twin.data[len(self.data):n])
+                    self.setDataState(state)
+            key = repository.disk.dataKey(self)
+            stored = repository.disk.read(key, 'data')
+            if stored is not None and len(stored) > len(self.data):
+                n = min(len(stored), mReps)
+                n, state = (n, None) if counter else repository.disk.readState(key, n)
+                if n > len(self.data):
+                    self.data.extend(stored[len(self.data):n])
+                    self.setDataState(state)
+            numNewReps = mReps - len(self.data)
+            if numNewReps > 0 and counter:
+                self.data.extend(self.simulateReplicates(len(self.data), mReps))
+            elif numNewReps > 0:
+                self.data.extend(self.simulateBatch(numNewReps, self.simRNG))  # Don't want to use self.R elsewhere
+                self.setDataState(self.simRNG.get_state())
+            if key is not None and (stored is None or len(stored) < len(self.data)):  # appends what the store lacks
+                repository.disk.write(key, 'data', self.data.view(), None if counter else self.dataStates[-1][1])
+            repository.twins.add(self)
+            return
+        for n in range(numNewReps):  # one at a time to save the hidden states
+            RNG = self.simRNG.replicates(len(self.data), 1) if counter else self.simRNG
+            self.data.append(self.simulateOnce(RNG))
+            self.hiddenStates.append(self.hiddenStateTrajectory)
+
+    def dataState(self, mReps):  # (n, RNG state after n replicates) for the longest data up to mReps that can be reused
+        if isinstance(self.simRNG, CounterRNG):
+            return min(len(self.data), mReps), None
+        i = bisect.bisect_right([n for n, state in self.dataStates], mReps)
+        return self.dataStates[i - 1] if i > 0 else (0, None)
+
+    def setDataState(self, state):  # the RNG continues from state, which follows the data so far
+        if state is not None:
+            self.simRNG.set_state(state)
+            self.dataStates.append((len(self.data), state))
+
+    def refresh(self):  # Overload: brings what the model caches from its parameters up to date
+        pass
+
+    def simulateReplicates(self, start, stop):  # data of replicates start..stop-1, from a CounterRNG only
+        assert isinstance(self.simRNG, CounterRNG)  # a pure function of the seed and the replicate number
+        return self.simulateBatch(stop - start, self.simRNG.replicates(start, stop - start))
 
     def sim(self, len_data=None):
         if len_data is None:
@@ -234,7 +742,24 @@ class FlatToy(object):
             self.hiddenStateTrajectory = (RNG.exponential(1./self.q1), RNG.exponential(1./self.q0))
         return sum(self.hiddenStateTrajectory)
 
-    def likelihoods(self, trueModel=None, selection=True):
+    def simulateBatch(self, n, RNG=None):  # Overload along with simulateOnce: n data, same draws as n simulateOnce
+        if RNG is None:
+            RNG = self.initRNG(None)
+        if type(self).simulateOnce.im_func is not FlatToy.simulateOnce.im_func:
+            return self.simulateEach(n, RNG)  # subclass has no vectorized simulator
+        if self.toy2:
+            return RNG.exponential(1./self.q, size=n)
+        times = RNG.standard_exponential(size=(n, 2))  # exponential(scale) is scale*standard_exponential
+        return 0. + times[:, 0] * (1./self.q1) + times[:, 1] * (1./self.q0)
+
+    def simulateEach(self, n, RNG=None):
+        if RNG is None:
+            RNG = self.initRNG(None)
+        if isinstance(RNG, CounterRNG):  # each replicate from its own counters
+            return [self.simulateOnce(RNG.replicates(RNG.start + i, 1)) for i in range(n)]
+        return [self.simulateOnce(RNG) for i in range(n)]
+
+    def likelihoods(self, trueModel=None, selection=True, rows=None):  # rows: a slice of the selection
         if trueModel is None:  # Data not passed
             trueModel = self
         if selection is True:
@@ -243,7 +768,8 @@ class FlatToy(object):
             print "Must have data in true model"
             return []
         likes = self.extend_likes(trueModel, selection.mReps)
-        return [likes[i] for i in selection.choice]
+        choice = selection.choice if rows is None else selection.choice[rows]
+        return likes[choice.ravel()]
 
     def process_mReps(self, mReps=True):
         try:   # if mReps is a Select object, return maximum needed mReps (in base) to generate all needed data
@@ -261,13 +787,26 @@ class FlatToy(object):
         if trueModel is None:
             trueModel = self
         mReps = trueModel.process_mReps(mReps)
+        self.refresh()
         trueModel.extend_data(mReps)
         likes = trueModel.likes.getOrMakeEntry(self)
         mFirst = len(likes)
         mLast = mReps
         assert(mReps > 0)  # Must have some data to run likelihoods
-        for datum in trueModel.data[mFirst:mLast]:
-            likes.append(self.likeOnce(datum))
+        if mLast > mFirst:
+            twin = repository.twins.get(trueModel) if not trueModel.debugFlag else None
+            shared = None if twin is None else twin.likes.get(self)
+            if shared is not None and len(shared) > mFirst:  # computed for a twin of trueModel
+                likes.extend(shared[mFirst:min(len(shared), mLast)])
+                mFirst = len(likes)
+            key = repository.disk.likesKey(self, trueModel)
+            stored = repository.disk.read(key, 'likes')
+            if stored is not None and len(stored) > mFirst:
+                likes.extend(stored[mFirst:min(len(stored), mLast)])
+            if mLast > len(likes):
+                likes.extend(self.likeBatch(trueModel.data[len(likes):mLast]))
+                repository.disk.write(key, 'likes', likes.view())
+            repository.cache.enforce(likes)  # the budget may now be exceeded
         return likes
 
     def get_data(self, mReps=True):
@@ -284,7 +823,7 @@ class FlatToy(object):
     def get_bootstrap_data(self, selection=True):
         if selection is True:
             selection = self.selection
-        return [self.data[i] for i in selection.choice]
+        return self.data[selection.choice.ravel()]
 
     def get_bootstrap_likes(self, trueModel=None, selection=True):
         return self.likelihoods(trueModel, selection)
@@ -300,6 +839,79 @@ class FlatToy(object):
             return numpy.log(self.q1) + numpy.log(self.q0) + numpy.log(
                 (numpy.exp(-self.q0 * datum) - numpy.exp(-self.q1 * datum)) / (self.q1 - self.q0))
 
+    def likeBatch(self, data):  # Overload along with likeOnce: likeOnce of each datum, as an array
+        data = numpy.asarray(data)
+        if type(self).likeOnce.im_func is not FlatToy.likeOnce.im_func or data.dtype.kind not in 'iuf':
+            return self.likeEach(data)  # no vectorized likelihood, or data are not numbers
+        supported = (data >= 0.) if self.toy2 else (data > 0.)
+        datum = data
+        with numpy.errstate(all='ignore'):  # unsupported data are -inf below
+            if self.toy2:
+                L = numpy.log(self.q) - self.q * datum
+            elif self.q0 == self.q1:
+                L = numpy.log(self.q1) + numpy.log(self.q0) - self.q0 * datum + numpy.log(datum)
+            else:
+                L = numpy.log(self.q1) + numpy.log(self.q0) + numpy.log(
+                    (numpy.exp(-self.q0 * datum) - numpy.exp(-self.q1 * datum)) / (self.q1 - self.q0))
+        return numpy.where(supported, L, -numpy.infty)
+
+    def likeEach(self, data):
+        return [self.likeOnce(datum) for datum in data]
+
+    def likeFamily(self, family, data):  # Overload along with likeBatch: likeBatch of each member, K x len(data)
+        data = numpy.asarray(data)
+        if (type(self).likeOnce.im_func is not FlatToy.likeOnce.im_func or
+                type(self).likeBatch.im_func is not FlatToy.likeBatch.im_func or data.dtype.kind not in 'iuf'):
+            return numpy.array([family.member(k).likeBatch(data) for k in range(family.K)],
+                               dtype=float).reshape(family.K, len(data))
+        toy2 = family.column('toy2')
+        assert numpy.all(toy2 == toy2[0])  # members all toy 2 or all toy 3
+        datum = data[numpy.newaxis, :]
+        supported = (datum >= 0.) if toy2[0] else (datum > 0.)
+        with numpy.errstate(all='ignore'):  # unsupported data are -inf below
+            if toy2[0]:
+                q = family.column('q')
+                L = numpy.log(q) - q * datum
+            else:
+                q0, q1 = family.column('q0'), family.column('q1')
+                L = numpy.where(q0 == q1,
+                                numpy.log(q1) + numpy.log(q0) - q0 * datum + numpy.log(datum),
+                                numpy.log(q1) + numpy.log(q0) + numpy.log(
+                                    (numpy.exp(-q0 * datum) - numpy.exp(-q1 * datum)) / (q1 - q0)))
+        return numpy.where(supported, L, -numpy.infty)
+
+    def support(self):  # Overload for discrete data: the sorted array of the values a datum can take
+        return None
+
+    def supportIndex(self, data):  # position of each datum in the support
+        support = self.support()
+        index = numpy.minimum(numpy.searchsorted(support, data), len(support) - 1)
+        assert numpy.all(support[index] == data)  # data outside the support
+        return index
+
+    def valueCounts(self, mReps=True):  # counts of each support value in the first mReps data
+        mReps = self.process_mReps(mReps)
+        if self.counted is None:
+            self.counted = numpy.zeros(len(self.support()), dtype=numpy.int64)
+        data = self.get_data(max(mReps, self.countedReps))
+        if mReps > self.countedReps:  # kept up to date as the data grow
+            self.counted += numpy.bincount(self.supportIndex(data[self.countedReps:mReps]),
+                                           minlength=len(self.counted))
+            self.countedReps = mReps
+        if mReps == self.countedReps:
+            return self.counted.copy()
+        return self.counted - numpy.bincount(self.supportIndex(data[mReps:self.countedReps]),
+                                             minlength=len(self.counted))
+
+    def supportLikes(self, support):  # likeBatch over a support, computed once per support
+        key = support.tostring()
+        try:
+            return self.supportTables[key]
+        except KeyError:
+            table = numpy.asarray(self.likeBatch(support), dtype=float)
+            self.supportTables[key] = table
+            return table
+
     def datumWellFormed(self, datum):
         return isinstance(datum, float) or isinstance(datum, int)
 
@@ -314,10 +926,15 @@ class FlatToy(object):
             return True
 
     def minuslike(self, trueModel=None, selection=True):
-        L = self.likelihoods(trueModel, selection)
-        return -sum(L)
+        return -self.like(trueModel, selection)
 
     def like(self, trueModel=None, selection=True):
+        counts = self.countSelection(trueModel, selection)
+        if counts is not None:
+            return counts.sum(self.supportLikes(counts.support))
+        weighted_true, weights = self.weighted(trueModel, selection)
+        if weights is not None:
+            return weights.result(weights.sum(self.extend_likes(weighted_true, weights.mReps)))
         L = self.likelihoods(trueModel, selection)
         return sum(L)
 
@@ -331,6 +948,7 @@ class FlatToy(object):
         return density_curve
 
     def compare_bars(self, alt, xmax, figax=None):  # Useful when range = {0,1,2,...xmax}
+        plt = pyplot()
         if figax is None:
             figax = plt.subplots()
         x_iterable = numpy.arange(float(xmax))
@@ -343,6 +961,7 @@ class FlatToy(object):
         return figax
 
     def compare_3bars(self, alt0, alt1, xmax, figax=None, xlab=None):
+        plt = pyplot()
         if figax is None:
             figax = plt.subplots()
         x_iterable = numpy.arange(float(xmax))
@@ -363,6 +982,8 @@ class FlatToy(object):
         return figax
 
     def compare_pdfs(self, alt, dataModel=None, a=None, b=None, n=1000, bins=10, xlab=None):
+        plt = pyplot()
+        import matplotlib.patches
         assert not (dataModel is None and (a is None or b is None))
         if dataModel is True:
             dataModel = self
@@ -409,6 +1030,7 @@ class FlatToy(object):
         plt.show()
 
     def pdf_plot(self, x_iterable):
+        plt = pyplot()
         density_curve = self.pdf_of_iterable(x_iterable)
         plt.figure()
         # ax = plt.gca()
@@ -429,6 +1051,98 @@ class FlatToy(object):
         cv = self.base.likeRatioCV(alt.base, trueModel.base, selection)
         return (scipy.stats.norm.ppf(C)*cv)**2
 
+    def weighted(self, trueModel=None, selection=True):  # (trueModel, Weights) for a count-weighted bootstrap
+        if trueModel is None:
+            trueModel = self
+        if selection is True:
+            selection = trueModel.selection
+        if not isinstance(selection, Weights):
+            return None, None
+        return trueModel, selection
+
+    def countSelection(self, trueModel=None, selection=True):  # the Counts of a counted bootstrap, or None
+        if trueModel is None:
+            trueModel = self
+        if selection is True:
+            selection = trueModel.selection
+        return selection if isinstance(selection, Counts) else None
+
+    def supportLikeRatios(self, alt, counts):  # likelihood ratio of each support value
+        with numpy.errstate(invalid='ignore'):  # -inf - (-inf) where neither model can produce a value
+            return self.supportLikes(counts.support) - alt.supportLikes(counts.support)
+
+    def baseLikeRatios(self, alt, trueModel, weights):  # likelihood ratios of the replicates weights draws from
+        return (self.extend_likes(trueModel, weights.mReps)[0:weights.mReps] -
+                alt.extend_likes(trueModel, weights.mReps)[0:weights.mReps])
+
+    def likeRatioStream(self, alt, trueModel=None, selection=True, stream=None, block=65536):
+        # feeds the likelihood ratios of the selection to a RatioStream a block at a time and returns it;
+        # read PFalsify, KL and the moments from the one stream
+        if trueModel is None:
+            trueModel = self
+        if selection is True:
+            selection = trueModel.selection
+        if stream is None:
+            stream = RatioStream()
+        if isinstance(selection, Weights):
+            assert selection.nBoot == 1
+            for start in range(0, selection.mReps, block):
+                stop = min(start + block, selection.mReps)
+                stream.add(self.extend_likes(trueModel, selection.mReps)[start:stop] -
+                           alt.extend_likes(trueModel, selection.mReps)[start:stop], selection.counts[0, start:stop])
+            return stream
+        for start in range(0, len(selection.choice), block):
+            rows = slice(start, start + block)
+            stream.add(self.likelihoods(trueModel, selection, rows=rows) -
+                       alt.likelihoods(trueModel, selection, rows=rows))
+        return stream
+
+    def sequential(self, alt, statistic='PFalsify', halfWidth=0.01, trueModel=None, C=0.95, block=10000,
+                   maxReps=10**7):
+        # Sequential Monte Carlo: extends the true model's data and the likelihoods block repeated experiments
+        # at a time (consecutive base replicates, as sim()) until the C confidence interval of the statistic
+        # ('PFalsify', 'KL' or 'muSigma') is at most 2*halfWidth wide, or maxReps experiments are used.
+        # Returns the estimate, the interval (for 'muSigma', of mu) and the number of experiments.
+        if trueModel is None:
+            trueModel = self
+        assert statistic in ('PFalsify', 'KL', 'muSigma')
+        rReps = trueModel.rReps
+        hyp, alt, trueModel = self.base, alt.base, trueModel.base
+        stream = RatioStream()
+        while True:
+            first = stream.n
+            last = min(first + block, maxReps)
+            ratios = (hyp.get_likes(trueModel, last*rReps)[first*rReps:] -
+                      alt.get_likes(trueModel, last*rReps)[first*rReps:])
+            stream.add(ratios.reshape(last - first, rReps).sum(axis=1))
+            if statistic == 'PFalsify':
+                interval = stream.PFalsifyInterval(C)
+            else:
+                interval = stream.meanInterval(C)
+            if (interval[1] - interval[0])/2. <= halfWidth or stream.n >= maxReps:
+                break
+        estimates = {'PFalsify': stream.PFalsify, 'KL': stream.KL, 'muSigma': stream.muSigma}
+        return estimates[statistic](), interval, stream.n
+
+    def randomizedQMC(self, alt, statistic='KL', trueModel=None, mReps=1024, randomizations=8, seed=None,
+                      RNG=SobolRNG):
+        # KL or PFalsify from data of trueModel simulated with independent randomizations of an InversionRNG
+        # (randomized Sobol points, or AntitheticRNG pairs), mReps experiments each; mReps a power of 2 suits
+        # Sobol.  Returns the mean of the randomizations' estimates and its standard error.
+        if trueModel is None:
+            trueModel = self
+        assert statistic in ('PFalsify', 'KL')
+        rReps = trueModel.rReps
+        hyp, alt, trueModel = self.base, alt.base, trueModel.base
+        seeds = SaveStateRNG(seed).randint(2**31, size=randomizations)
+        estimates = numpy.empty(randomizations)
+        for k, s in enumerate(seeds):
+            data = trueModel.spawn(seed=RNG(s))
+            ratios = hyp.get_likes(data, mReps*rReps) - alt.get_likes(data, mReps*rReps)
+            ratios = ratios.reshape(mReps, rReps).sum(axis=1)
+            estimates[k] = (ratios > 0).mean() if statistic == 'PFalsify' else ratios.mean()
+        return estimates.mean(), estimates.std(ddof=1)/numpy.sqrt(randomizations)
+
     def likeRatios(self, alt, trueModel=None, selection=True):  # likelihood ratio; self is true model
         if trueModel is None:
             trueModel = self  # if true=None, want alt(hyp) not alt(alt), below
@@ -437,11 +1151,14 @@ class FlatToy(object):
         return self.logf(trueModel, selection) - alt.logf(trueModel, selection)
 
     def dataHistogram(self, bins=10):
+        plt = pyplot()
         plt.figure()
         plt.gca()
         plt.hist(numpy.array(self.data[0:self.mReps]), bins=bins, normed=True, color='black')
 
     def likeRatioHistogram(self, alt, trueModel=None, bins=10):
+        plt = pyplot()
+        import matplotlib.patches
         likelihood_ratios = self.likeRatios(alt, trueModel)
         plt.figure()
         ax = plt.gca()
@@ -458,6 +1175,24 @@ class FlatToy(object):
         plt.title(self.str_hat(alt, trueModel))
 
     def PFalsify(self, alt, trueModel=None, selection=True, adjustExtreme=False):
+        counts = self.countSelection(trueModel, selection)
+        if counts is not None:
+            number_of_ratios = counts.total()
+            number_of_positives = counts.counts[self.supportLikeRatios(alt, counts) > 0].sum()
+            if adjustExtreme and number_of_positives == 0:
+                number_of_positives += 0.5
+            elif adjustExtreme and number_of_positives == number_of_ratios:
+                number_of_positives -= 0.5
+            return number_of_positives/float(number_of_ratios)
+        weighted_true, weights = self.weighted(trueModel, selection)
+        if weights is not None:
+            number_of_ratios = weights.total().astype(float)
+            number_of_positives = weights.sum(self.baseLikeRatios(alt, weighted_true, weights) > 0).astype(float)
+            if adjustExtreme:
+                number_of_positives[number_of_positives == 0] = 0.5
+                extreme = number_of_positives == number_of_ratios
+                number_of_positives[extreme] -= 0.5
+            return weights.result(weights.divide(number_of_positives, number_of_ratios))
         ratios = self.likeRatios(alt, trueModel, selection)
         number_of_ratios = ratios.shape[1]
         if number_of_ratios == 0:
@@ -473,7 +1208,92 @@ class FlatToy(object):
             number_of_positives -= 0.5
         return number_of_positives/float(number_of_ratios)
 
+    def tilted(self, alt, t=None, seed=None):
+        # A model to simulate from for importance sampling: f_self^(1-t) f_alt^t, normalized, a member of the
+        # exponentially tilted family between self and alt.  t=None is the tilt under which the mean
+        # log-likelihood ratio of self to alt is 0, the boundary of falsification.  Tilted exponentials are
+        # exponential; for other models (overload if their tilted family can be simulated) only t=0 (self)
+        # and t=1 (alt, also the default) are available.
+        if t == 0:
+            return self
+        exponentials = (type(self) is FlatToy and type(alt) is FlatToy and self.toy2 and alt.toy2 and
+                        self.q != alt.q)
+        if t == 1 or (t is None and not exponentials):
+            return alt
+        assert exponentials  # no tilted family to simulate from
+        if t is None:
+            q = (self.q - alt.q)/numpy.log(self.q/alt.q)
+        else:
+            q = (1.-t)*self.q + t*alt.q
+        return Toy([q]).flatten(seed)
+
+    def PFalsifyImportance(self, alt, trueModel=None, proposal=None, mReps=True, rReps=None, tilt=None, seed=None,
+                           stderr=False):
+        # Importance-sampling PFalsify for experiments of rReps repetitions (rReps of self by default).
+        # The data are simulated from proposal (by default trueModel tilted towards alt, see tilted) and
+        # weighted by f_true/f_proposal, from the likelihoods of each model on the proposal's data, so the
+        # small probability of not falsifying, 1-PFalsify, is estimated from many samples rather than a
+        # handful.  mReps counts base replicates drawn from the proposal, by default (True or None) as many as
+        # trueModel holds; seed is the seed of a tilted proposal.
+        if trueModel is None:
+            trueModel = self
+        if rReps is None:
+            rReps = self.rReps
+        hyp, alt, trueModel = self.base, alt.base, trueModel.base
+        if proposal is None:
+            proposal = trueModel.tilted(alt, tilt, seed)
+        proposal = proposal.base
+        mReps = trueModel.process_mReps(mReps)  # a new tilted proposal has no data of its own yet
+        n = mReps // rReps
+        if n <= 0:
+            raise ValueError('PFalsifyImportance needs mReps >= rReps (%d < %d): simulate trueModel or pass mReps'
+                             % (mReps, rReps))
+        ratios = (hyp.get_likes(proposal, n*rReps) - alt.get_likes(proposal, n*rReps)).reshape(n, rReps).sum(axis=1)
+        with numpy.errstate(invalid='ignore'):  # -inf - (-inf): data the true model cannot produce
+            logWeights = trueModel.get_likes(proposal, n*rReps) - proposal.get_likes(proposal, n*rReps)
+        logWeights = numpy.where(numpy.isnan(logWeights), -numpy.infty, logWeights).reshape(n, rReps).sum(axis=1)
+        misses = numpy.where(ratios > 0, 0., numpy.exp(logWeights))  # weighted indicators of not falsifying
+        P = 1. - misses.mean()
+        if stderr:
+            return P, misses.std()/numpy.sqrt(n)
+        return P
+
+    def controlled(self, alt, controls, statistic='KL', trueModel=None, selection=True, stderr=False):
+        # Control-variate KL or PFalsify of self and alt.  controls: (hyp, alt, exact) triples of models whose
+        # statistic under trueModel is known exactly (e.g. from Toy.exact or Simple.exact).  Their Monte
+        # Carlo statistics on the same selection carry the same sampling noise as ours; it is regressed out
+        # with the least-squares coefficients, leaving the noise the controls do not explain.
+        if trueModel is None:
+            trueModel = self
+        if selection is True:
+            selection = trueModel.selection
+        assert statistic in ('PFalsify', 'KL')
+        assert not isinstance(selection, Weights)  # one selection at a time
+
+        def samples(hyp, other):
+            ratios = numpy.asarray(hyp.likeRatios(other, trueModel, selection)).ravel()
+            return (ratios > 0).astype(float) if statistic == 'PFalsify' else ratios
+
+        y = samples(self, alt)
+        C = numpy.array([samples(hyp, other) for hyp, other, exact in controls]).reshape(len(controls), len(y)).T
+        exact = numpy.array([exact for hyp, other, exact in controls], dtype=float)
+        centered = C - C.mean(axis=0)
+        beta = numpy.linalg.lstsq(centered, y - y.mean(), rcond=-1)[0]
+        estimate = y.mean() - (C.mean(axis=0) - exact).dot(beta)
+        if stderr:
+            residuals = y - y.mean() - centered.dot(beta)
+            return estimate, residuals.std() / numpy.sqrt(len(y))
+        return estimate
+
     def likeRatioMuSigma(self, alt, trueModel=None, selection=True):  # self is true model
+        counts = self.countSelection(trueModel, selection)
+        if counts is not None:
+            ratios = self.supportLikeRatios(alt, counts)
+            return counts.mean(ratios), counts.std(ratios)
+        weighted_true, weights = self.weighted(trueModel, selection)
+        if weights is not None:
+            ratios = self.baseLikeRatios(alt, weighted_true, weights)
+            return weights.result(weights.mean(ratios)), weights.result(weights.std(ratios))
         lrs = self.likeRatios(alt, trueModel, selection)
         mu = numpy.mean(lrs)
         sig = numpy.std(lrs)
@@ -511,6 +1331,9 @@ class FlatToy(object):
         return A.sum(axis=0)
 
     def Ehlogf(self, trueModel=None, selection=True):
+        weighted_true, weights = self.weighted(trueModel, selection)
+        if weights is not None:
+            return weights.result(weights.mean(self.extend_likes(weighted_true, weights.mReps)))
         return (self.logf(trueModel, selection).mean())
 
     def KL(self, other, trueModel=None, selection=True):
@@ -519,6 +1342,12 @@ class FlatToy(object):
         if selection is True:
             selection = trueModel.selection
         # ORIGINALLY (less stable?):  return self.Ehlogf(trueModel) - other.Ehlogf(trueModel)
+        counts = self.countSelection(trueModel, selection)
+        if counts is not None:
+            return counts.mean(self.supportLikeRatios(other, counts))
+        weighted_true, weights = self.weighted(trueModel, selection)
+        if weights is not None:
+            return weights.result(weights.mean(self.baseLikeRatios(other, weighted_true, weights)))
         return (self.logf(trueModel, selection) - other.logf(trueModel, selection)).mean()
 
 